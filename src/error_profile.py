@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+"""
+This script defines the error profiles written by simulator.py, which record the errors introduced into each read, and
+converts binary error profiles to the tab-separated text format.
+usage: python error_profile.py -i simulated_aligned_error_profile.nserr -o simulated_aligned_error_profile
+"""
+
+from __future__ import with_statement
+import mmap
+import struct
+import argparse
+import numpy as np
+import file_handler as fh
+
+
+ERROR_TYPES = ["mis", "ins", "del"]
+TEXT_HEADER = "Seq_name\tSeq_pos\terror_type\terror_length\tref_base\tseq_base\n"
+
+# Binary error profiles (.nserr) are the magic (8 bytes) followed by one chunk per batch of reads:
+#   header: numbers of records, events and bases, and length of the record names (uint64)
+#   record names joined by newlines, then for the records: offsets of their first events and of their first bases
+#   (int64, one more than the records), then for the events: positions and lengths (uint32) and types (uint8, index
+#   in ERROR_TYPES), then the reference bases and the read bases of all events, "-" for inserted and deleted bases
+# A record holds the errors of one call to mutate_read, sorted by position, insertions being placed before the base at
+# their position. Each section starts at a multiple of 8 bytes.
+BINARY_SUFFIX = ".nserr"
+BINARY_MAGIC = b"NSERR\x00\x00\x01"
+CHUNK_HEADER = struct.Struct("<4Q")
+GAP = ord("-")
+
+
+def event_bases(read_bases, new_bases, ins_bases, e_pos, e_type, e_len):
+    # Reference and read bases of the errors introduced into read_bases by mutate_read, concatenated in event order.
+    # new_bases are the read bases after mismatches, and ins_bases the inserted bases in event order
+    ends = np.cumsum(e_len)
+    pos = np.repeat(e_pos - ends + e_len, e_len) + np.arange(ends[-1] if len(ends) else 0)
+    base_type = np.repeat(e_type, e_len)
+    ref = np.full(len(pos), GAP, dtype=np.uint8)
+    new = ref.copy()
+    not_ins = base_type != 1
+    ref[not_ins] = read_bases[pos[not_ins]]
+    is_mis = base_type == 0
+    new[is_mis] = new_bases[pos[is_mis]]
+    new[base_type == 1] = ins_bases
+    return ref, new
+
+
+def text_lines(read_name, e_pos, e_type, e_len, ref, new):
+    # Lines of the text error profile for the events of one record, last event first. e_pos, e_type and e_len are lists
+    ref = ref.tobytes().decode()
+    new = new.tobytes().decode()
+    lines = []
+    end = len(ref)
+    for i in range(len(e_pos) - 1, -1, -1):
+        start = end - e_len[i]
+        lines.append(read_name + "\t" + str(e_pos[i]) + "\t" + ERROR_TYPES[e_type[i]] + "\t" + str(e_len[i]) + "\t" +
+                     ref[start: end] + "\t" + new[start: end] + "\n")
+        end = start
+    return ''.join(lines)
+
+
+# Error log of one batch of reads in the text format
+class text_error_log(object):
+    def __init__(self):
+        self.buffer = []
+
+    def write_events(self, read_name, e_pos, e_type, e_len, ref, new):
+        self.buffer.append(text_lines(read_name, e_pos.tolist(), e_type.tolist(), e_len.tolist(), ref, new))
+
+    def close(self):
+        pass
+
+    def getvalue(self):
+        return ''.join(self.buffer)
+
+
+# Error log of one batch of reads, encoded as a chunk of a binary error profile by getvalue
+class binary_error_log(object):
+    def __init__(self):
+        self.names = []
+        self.num_events = [0]
+        self.num_bases = [0]
+        self.e_pos = []
+        self.e_type = []
+        self.e_len = []
+        self.ref = []
+        self.new = []
+
+    def write_events(self, read_name, e_pos, e_type, e_len, ref, new):
+        self.names.append(read_name)
+        self.num_events.append(len(e_pos))
+        self.num_bases.append(len(ref))
+        self.e_pos.append(e_pos)
+        self.e_type.append(e_type)
+        self.e_len.append(e_len)
+        self.ref.append(ref)
+        self.new.append(new)
+
+    def close(self):
+        pass
+
+    def getvalue(self):
+        if not self.names:
+            return b""
+        names = "\n".join(self.names).encode()
+        ref = np.concatenate(self.ref)
+        sections = [names,
+                    np.cumsum(self.num_events, dtype=np.int64).tobytes() +
+                    np.cumsum(self.num_bases, dtype=np.int64).tobytes(),
+                    np.concatenate(self.e_pos).astype(np.uint32).tobytes() +
+                    np.concatenate(self.e_len).astype(np.uint32).tobytes() +
+                    np.concatenate(self.e_type).astype(np.uint8).tobytes(),
+                    ref.tobytes(),
+                    np.concatenate(self.new).tobytes()]
+        num_events = sum(self.num_events)
+        data = [CHUNK_HEADER.pack(len(self.names), num_events, len(ref), len(names))]
+        for section in sections:
+            data.append(section + b"\x00" * (-len(section) % 8))
+        return b"".join(data)
+
+
+ERROR_LOGS = {"text": text_error_log, "binary": binary_error_log}
+
+
+def padded(size):
+    return size + (-size % 8)
+
+
+class error_chunk(object):
+    # The arrays of one chunk of a memory mapped binary error profile. The events of record i are
+    # e_pos, e_type, e_len[event_offsets[i]: event_offsets[i + 1]], and their bases are
+    # ref, new[base_offsets[i]: base_offsets[i + 1]]
+    def __init__(self, data, offset):
+        num_records, num_events, num_bases, names_len = CHUNK_HEADER.unpack_from(data, offset)
+        offset += CHUNK_HEADER.size
+        self.names = bytes(data[offset: offset + names_len]).decode().split("\n")
+        offset += padded(names_len)
+        self.event_offsets = np.frombuffer(data, dtype=np.int64, count=num_records + 1, offset=offset)
+        offset += 8 * (num_records + 1)
+        self.base_offsets = np.frombuffer(data, dtype=np.int64, count=num_records + 1, offset=offset)
+        offset += 8 * (num_records + 1)
+        self.e_pos = np.frombuffer(data, dtype=np.uint32, count=num_events, offset=offset)
+        self.e_len = np.frombuffer(data, dtype=np.uint32, count=num_events, offset=offset + 4 * num_events)
+        self.e_type = np.frombuffer(data, dtype=np.uint8, count=num_events, offset=offset + 8 * num_events)
+        offset += padded(9 * num_events)
+        self.ref = np.frombuffer(data, dtype=np.uint8, count=num_bases, offset=offset)
+        offset += padded(num_bases)
+        self.new = np.frombuffer(data, dtype=np.uint8, count=num_bases, offset=offset)
+        self.end = offset + padded(num_bases)
+
+    def record(self, i):
+        # Name, positions, types, lengths, reference bases and read bases of the events of record i
+        first, last = self.event_offsets[i: i + 2]
+        base_first, base_last = self.base_offsets[i: i + 2]
+        return (self.names[i], self.e_pos[first: last], self.e_type[first: last], self.e_len[first: last],
+                self.ref[base_first: base_last], self.new[base_first: base_last])
+
+
+class binary_error_profile(object):
+    # A memory mapped binary error profile. Records are looked up by read name with events(), which builds an index of
+    # the names on its first call
+    def __init__(self, file_path):
+        with open(file_path, "rb") as in_file:
+            if in_file.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+                raise ValueError(file_path + " is not a binary error profile")
+            self.data = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.chunks = []
+        offset = len(BINARY_MAGIC)
+        while offset < len(self.data):
+            chunk = error_chunk(self.data, offset)
+            self.chunks.append(chunk)
+            offset = chunk.end
+        self.index = None
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            for i in range(len(chunk.names)):
+                yield chunk.record(i)
+
+    def events(self, read_name):
+        # List of the records (as returned by error_chunk.record) of read_name
+        if self.index is None:
+            self.index = {}
+            for chunk in self.chunks:
+                for i, name in enumerate(chunk.names):
+                    self.index.setdefault(name, []).append((chunk, i))
+        return [chunk.record(i) for chunk, i in self.index.get(read_name, [])]
+
+
+def binary_to_text(in_path, out_path):
+    profile = binary_error_profile(in_path)
+    with fh.gzopen(out_path, 'wt') as out_file:
+        out_file.write(TEXT_HEADER)
+        for read_name, e_pos, e_type, e_len, ref, new in profile:
+            out_file.write(text_lines(read_name, e_pos.tolist(), e_type.tolist(), e_len.tolist(), ref, new))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a binary error profile (.nserr) written by simulator.py "
+                                                 "to the tab-separated text format")
+    parser.add_argument('-i', '--input', help='Input binary error profile', required=True)
+    parser.add_argument('-o', '--output', help='Output text error profile, gzip compressed if it ends with .gz',
+                        required=True)
+    args = parser.parse_args()
+    binary_to_text(args.input, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,85 @@
 #!/usr/bin/env python
 
 import gzip
+import struct
+import zlib
 
 # function to open both gzip'd and regular files
 def gzopen(file_path, mode='rt', compresslevel=6):
     if file_path.lower().endswith('.gz'):
         return gzip.open(file_path, mode=mode, compresslevel=compresslevel)
     return open(file_path, mode)
+
+
+# File-like object collecting the output of one batch of reads in memory. Unlike StringIO, the text is still available
+# after close
+class batch_writer(object):
+    def __init__(self):
+        self.buffer = []
+
+    def write(self, text):
+        self.buffer.append(text)
+
+    def close(self):
+        pass
+
+    def getvalue(self):
+        return ''.join(self.buffer)
+
+
+# Compressed outputs are made of independent gzip members, which can be compressed in parallel and concatenated.
+# BGZF members hold at most BGZF_BLOCK_SIZE bytes of text and record their own size, as in samtools' bgzip
+COMPRESS_EXT = {"none": "", "gzip": ".gz", "bgzf": ".gz"}
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_EOF = (b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00"
+            b"\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00")
+
+
+def compress_text(text, method="none", level=6):
+    # Encode text for an output file compressed with method: none, gzip (a single gzip member) or bgzf
+    data = text.encode()
+    if not data or method == "none":
+        return data
+    if method == "gzip":
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        return compressor.compress(data) + compressor.flush()
+    return b"".join(bgzf_block(data[i: i + BGZF_BLOCK_SIZE], level) for i in range(0, len(data), BGZF_BLOCK_SIZE))
+
+
+def bgzf_block(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    # gzip header with the BC extra field holding the block size - 1, then the deflated data, CRC32 and input size
+    header = struct.pack("<4BI2BH2BHH", 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(deflated) + 25)
+    return header + deflated + struct.pack("<2I", zlib.crc32(data) & 0xffffffff, len(data))
+
+
+# Binary output file compressed with method (none, gzip or bgzf). Text is compressed as it is written, and text
+# already compressed with compress_text, e.g. by worker processes, is appended with write_compressed
+class compressed_writer(object):
+    def __init__(self, out_file, method="none", level=6):
+        self.method = method
+        self.level = level
+        self.out_file = out_file
+
+    def write(self, text):
+        self.out_file.write(compress_text(text, self.method, self.level))
+
+    def write_compressed(self, data):
+        self.out_file.write(data)
+
+    def close(self):
+        if self.method == "bgzf":
+            self.out_file.write(BGZF_EOF)
+        self.out_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def open_output(file_path, method="none", level=6):
+    # compressed_writer for file_path, with the extension of method
+    return compressed_writer(open(file_path + COMPRESS_EXT[method], 'wb'), method, level)
@@ -6,8 +6,9 @@ This script defines Poisson-Geometric distribution and Weibull-Geometric distrib
 """
 
 import numpy as np
-from math import ceil, exp
+from math import exp
 from scipy.stats import rv_discrete, poisson, geom, lognorm
+import performance as pf
 
 
 # Scipy geometric starts with x = 1
@@ -38,149 +39,97 @@ class weigeom2_gen(rv_discrete):
         return self.cdf(x, l, k, p, w) - self.cdf(x-1, l, k, p, w)
 
 
-class trunc_lognorm_gen(rv_discrete):
-    def _cdf(self, x, s, m):
-        lncdf_x = lognorm.cdf(x, s, scale=m)
-        lncdf_a = lognorm.cdf(self.a, s, scale=m)
-        lncdf_b = lognorm.cdf(self.b, s, scale=m)
-        return (lncdf_x - lncdf_a) / (lncdf_b - lncdf_a)
-
-    def _ppf(self, q, s, m):
-        lncdf_a = lognorm.cdf(self.a, s, scale=m)
-        lncdf_b = lognorm.cdf(self.b, s, scale=m)
-        ln_q = q * (lncdf_b - lncdf_a) + lncdf_a
-        return lognorm.ppf(ln_q, s, scale=m)
-
-
-def pois_geom(lam, prob, weight):
-    # Draw a random number from Poisson-Geometric distribution
-    # Faster to use numpy random than using Scipy rvs
-    tmp_rand = np.random.random()
-    if tmp_rand < weight:
-        value = np.random.poisson(lam) + 1
-    else:
-        value = np.random.geometric(prob)
+def pois_geom_rvs(lam, prob, weight, n):
+    # Draw n random numbers from Poisson-Geometric distribution: 1 + Poisson(lam) with probability weight, or else
+    # Geometric(prob) starting from 1
+    value = np.random.geometric(prob, n)
+    from_pois = np.random.random(n) < weight
+    value[from_pois] = np.random.poisson(lam, np.count_nonzero(from_pois)) + 1
     return value
 
 
-def wei_geom(lam, k, prob, weight):
-    # Draw a random number from Weibull-Geometric distribution
-    tmp_rand = np.random.random()
-    if tmp_rand < weight:
-        value = int(round(ceil(lam * np.random.weibull(k))))
-    else:
-        value = np.random.geometric(prob) - 1
-
-    if value == 0:
-        value = 1
-
+def wei_geom_rvs(lam, k, prob, weight, n):
+    # Draw n random numbers from Weibull-Geometric distribution: ceil(lam * Weibull(k)) with probability weight, or
+    # else Geometric(prob) starting from 0, with 0 drawn as 1
+    value = np.random.geometric(prob, n) - 1
+    from_wei = np.random.random(n) < weight
+    value[from_wei] = np.ceil(lam * np.random.weibull(k, np.count_nonzero(from_wei)))
+    value[value == 0] = 1
     return value
 
 
+class buffered_rvs(object):
+    # Serve single draws of rvs(*par, n) from blocks of block_size values drawn at once. Blocks are only drawn when
+    # needed, so a sampler created before forking does not share values between processes
+    def __init__(self, rvs, par, block_size=10000):
+        self.rvs = rvs
+        self.par = par
+        self.block_size = block_size
+        self.block = []
+
+    def draw(self):
+        if not self.block:
+            self.block = self.rvs(*(self.par + [self.block_size])).tolist()
+            self.block.reverse()
+        return self.block.pop()
+
+    def reset(self):
+        self.block = []
+
+
+# Truncation range and (mean, sd) of the log of base qualities for each basecaller, read type and error type
+TRUNC_LOGNORM_RANGE = {"albacore": (1, 28), "guppy": (1, 31)}
+DRNA_QUAL_PAR = {"match": (2.236641, 0.434045), "mis": (1.8138169, 0.4535039), "ins": (1.9322685, 0.4668444),
+                 "ht": (2.0166876, 0.5714308), "unaligned": (2.1371272, 0.4763441)}
+TRUNC_LOGNORM_PAR = {
+    "albacore": {
+        "DNA": {"match": (2.7418286, 0.7578693), "mis": (1.6597215, 0.6814804), "ins": (1.9016147, 0.6842999),
+                "ht": (2.3739153, 0.9635895), "unaligned": (2.5484921, 0.7742894)},
+        "dRNA": DRNA_QUAL_PAR,
+        "cDNA": {"match": (2.6003978, 0.7181057), "mis": (1.6380338, 0.6695235), "ins": (1.8462438, 0.6661691),
+                 "ht": (2.510699, 1.082626), "unaligned": (2.6004634, 0.8526468)}},
+    "guppy": {
+        "DNA": {"match": (2.9863022, 0.9493498), "mis": (1.6184245, 0.7585733), "ins": (1.8852560, 0.7623103),
+                "ht": (1.995397, 1.008650), "unaligned": (1.2626728, 0.9012829)},
+        "dRNA": DRNA_QUAL_PAR,
+        "cDNA": {"match": (2.7500148, 0.9195383), "mis": (1.5543628, 0.7601223), "ins": (1.765634, 0.777587),
+                 "ht": (2.001173, 1.008647), "unaligned": (1.2635415, 0.9008419)}}
+}
+
+# Cumulative probabilities of base qualities, computed once per (error_type, read_type, basecaller)
+trunc_lognorm_cdfs = {}
+
+
+def trunc_lognorm_cdf(error_type, read_type, basecaller):
+    key = (error_type, read_type, basecaller)
+    if key not in trunc_lognorm_cdfs:
+        a, b = TRUNC_LOGNORM_RANGE[basecaller]
+        read_par = TRUNC_LOGNORM_PAR[basecaller]
+        if read_type not in read_par:  # cDNA_1D, cDNA_1D2
+            read_type = "cDNA"
+        if error_type not in read_par[read_type]:
+            error_type = "unaligned"
+        mean, sd = read_par[read_type][error_type]
+
+        # Quality q is drawn when a truncated lognormal draw falls in [q, q + 1), for q in [a, b)
+        lncdf = lognorm.cdf(np.arange(a, b + 1), sd, scale=exp(mean))
+        cdf = (lncdf[1:] - lncdf[0]) / (lncdf[-1] - lncdf[0])
+        trunc_lognorm_cdfs[key] = (a, cdf)
+    return trunc_lognorm_cdfs[key]
+
+
+@pf.timed("quality_sampling")
 def trunc_lognorm_rvs(error_type, read_type, basecaller, n):
-    if basecaller == "albacore":
-        a = 1
-        b = 28
-        if read_type == "DNA":
-            if error_type == "match":
-                mean = 2.7418286
-                sd = 0.7578693
-            elif error_type == "mis":
-                mean = 1.6597215
-                sd = 0.6814804
-            elif error_type == "ins":
-                mean = 1.9016147
-                sd = 0.6842999
-            elif error_type == "ht":
-                mean = 2.3739153
-                sd = 0.9635895
-            else:  # unaligned
-                mean = 2.5484921
-                sd = 0.7742894
-        elif read_type == "dRNA":
-            if error_type == "match":
-                mean = 2.236641
-                sd = 0.434045
-            elif error_type == "mis":
-                mean = 1.8138169
-                sd = 0.4535039
-            elif error_type == "ins":
-                mean = 1.9322685
-                sd = 0.4668444
-            elif error_type == "ht":
-                mean = 2.0166876
-                sd = 0.5714308
-            else:  # unaligned
-                mean = 2.1371272
-                sd = 0.4763441
-        else:  # cDNA
-            if error_type == "match":
-                mean = 2.6003978
-                sd = 0.7181057
-            elif error_type == "mis":
-                mean = 1.6380338
-                sd = 0.6695235
-            elif error_type == "ins":
-                mean = 1.8462438
-                sd = 0.6661691
-            elif error_type == "ht":
-                mean = 2.510699
-                sd = 1.082626
-            else:  # unaligned
-                mean = 2.6004634
-                sd = 0.8526468
-    elif basecaller == "guppy":
-        a = 1
-        b = 31
-        if read_type == "DNA":
-            if error_type == "match":
-                mean = 2.9863022
-                sd = 0.9493498
-            elif error_type == "mis":
-                mean = 1.6184245
-                sd = 0.7585733
-            elif error_type == "ins":
-                mean = 1.8852560
-                sd = 0.7623103
-            elif error_type == "ht":
-                mean = 1.995397
-                sd = 1.008650
-            else:  # unaligned
-                mean = 1.2626728
-                sd = 0.9012829
-        elif read_type == "dRNA":
-            if error_type == "match":
-                mean = 2.236641
-                sd = 0.434045
-            elif error_type == "mis":
-                mean = 1.8138169
-                sd = 0.4535039
-            elif error_type == "ins":
-                mean = 1.9322685
-                sd = 0.4668444
-            elif error_type == "ht":
-                mean = 2.0166876
-                sd = 0.5714308
-            else:  # unaligned
-                mean = 2.1371272
-                sd = 0.4763441
-        else:  # cDNA
-            if error_type == "match":
-                mean = 2.7500148
-                sd = 0.9195383
-            elif error_type == "mis":
-                mean = 1.5543628
-                sd = 0.7601223
-            elif error_type == "ins":
-                mean = 1.765634
-                sd = 0.777587
-            elif error_type == "ht":
-                mean = 2.001173
-                sd = 1.008647
-            else:  # unaligned
-                mean = 1.2635415
-                sd = 0.9008419
-
-    m = exp(mean)
-    truncln_gen = trunc_lognorm_gen(name="truncln", a=a, b=b, shapes="s, m")
-    return truncln_gen.rvs(s=sd, m=m, size=n)
+    a, cdf = trunc_lognorm_cdf(error_type, read_type, basecaller)
+    idx = np.searchsorted(cdf, np.random.random(n), side="right")
+    return np.minimum(idx, len(cdf) - 1) + a
+
+
+def trunc_lognorm_phred(error_type, read_type, basecaller, n):
+    # Draw n base qualities and return them as a Phred+33 string
+    return phred_string(trunc_lognorm_rvs(error_type, read_type, basecaller, n))
+
+
+@pf.timed("quality_sampling")
+def phred_string(quals):
+    return (np.asarray(quals, dtype=np.uint8) + 33).tobytes().decode()
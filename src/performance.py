@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+"""
+This script records where the time of a simulation run goes: the wall and CPU time spent in each stage of simulator.py
+and counters of the simulated reads, for the main process and each worker process, written as a JSON report at the
+end of the run
+"""
+
+import os
+import json
+import time
+import functools
+
+
+STAGES = ["reference_load", "model_load", "species_planning", "length_sampling", "extract_read", "error_list",
+          "mutate_read", "mutate_homo", "quality_sampling", "output"]
+# rejected_lengths: length draws discarded for falling outside the allowed range, extract_retries: references drawn
+# again because the read did not fit, transcript_retries: transcripts drawn again or reads skipped for the same reason
+COUNTERS = ["reads", "bases", "rejected_lengths", "extract_retries", "transcript_retries"]
+
+
+class stage_stats(object):
+    # Wall and CPU seconds and number of calls of each stage, and counters, of one process. The time of a stage
+    # excludes the stages timed inside it, so that the stage times of a process add up
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.wall = dict.fromkeys(STAGES, 0.0)
+        self.cpu = dict.fromkeys(STAGES, 0.0)
+        self.calls = dict.fromkeys(STAGES, 0)
+        self.counts = dict.fromkeys(COUNTERS, 0)
+        self.stack = []
+
+    def start(self, stage):
+        self.stack.append([stage, time.perf_counter(), time.process_time(), 0.0, 0.0])
+
+    def stop(self):
+        stage, wall, cpu, child_wall, child_cpu = self.stack.pop()
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+        self.wall[stage] += wall - child_wall
+        self.cpu[stage] += cpu - child_cpu
+        self.calls[stage] += 1
+        if self.stack:
+            self.stack[-1][3] += wall
+            self.stack[-1][4] += cpu
+
+    def count(self, counter, n=1):
+        self.counts[counter] += int(n)
+
+    def add_read(self, length):
+        self.counts["reads"] += 1
+        self.counts["bases"] += length
+
+    def merge(self, other):
+        # Add the stats of other, as returned by to_dict
+        for stage, values in other["stages"].items():
+            self.wall[stage] += values["wall"]
+            self.cpu[stage] += values["cpu"]
+            self.calls[stage] += values["calls"]
+        for counter, n in other["counters"].items():
+            self.counts[counter] += n
+
+    def to_dict(self):
+        return {"stages": {x: {"wall": self.wall[x], "cpu": self.cpu[x], "calls": self.calls[x]} for x in STAGES},
+                "counters": dict(self.counts)}
+
+    def pop(self):
+        # to_dict of the stats so far, which are then cleared
+        values = self.to_dict()
+        self.clear()
+        return values
+
+
+# Stats of the current process. Worker processes clear the copy inherited from the main process, and send theirs to
+# it with each batch of reads
+stats = stage_stats()
+
+
+def timed(stage):
+    # Decorator timing each call of the function as stage
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            stats.start(stage)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats.stop()
+        return wrapper
+    return decorator
+
+
+class run_report(object):
+    # Stats of the worker processes of a run, by worker number, gathered by the main process
+    def __init__(self):
+        self.start_wall = time.perf_counter()
+        self.workers = {}
+
+    def add_worker(self, worker, values):
+        if worker not in self.workers:
+            self.workers[worker] = stage_stats()
+        self.workers[worker].merge(values)
+
+    def write(self, out_path, info):
+        # Write the report of the run so far to out_path, with the entries of info (e.g. the arguments) added.
+        # The CPU time includes the worker processes that have been joined
+        wall = time.perf_counter() - self.start_wall
+        times = os.times()
+        total = stage_stats()
+        total.merge(stats.to_dict())
+        for worker in self.workers.values():
+            total.merge(worker.to_dict())
+        report = dict(info)
+        report.update({"wall_time": wall,
+                       "cpu_time": times.user + times.system + times.children_user + times.children_system,
+                       "reads_per_second": total.counts["reads"] / wall if wall > 0 else 0.0,
+                       "bases_per_second": total.counts["bases"] / wall if wall > 0 else 0.0})
+        report.update(total.to_dict())
+        report["main"] = stats.to_dict()
+        report["workers"] = [dict(self.workers[x].to_dict(), worker=x) for x in sorted(self.workers)]
+        with open(out_path, 'w') as out_file:
+            json.dump(report, out_file, indent=2)
+            out_file.write("\n")
+
+
+report = run_report()
@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+
+"""
+This script defines the reference sequences used by simulator.py. References are converted to uppercase once when they
+are loaded, and only the ambiguous (non-ACGT) bases falling into an extracted fragment are resolved per read. The
+homopolymers of each reference are indexed when it is loaded, and extracted fragments carry those they contain.
+References read from files are packed 2 bits per base next to the FASTA file and memory mapped on later runs
+"""
+
+import os
+import re
+import random
+import json
+import mmap
+import struct
+import numpy as np
+
+
+IUPAC_CODES = {'Y': 'CT', 'R': 'AG', 'W': 'AT', 'S': 'GC', 'K': 'TG', 'M': 'CA', 'D': 'AGT', 'V': 'ACG', 'H': 'ACT',
+               'B': 'CGT', 'N': 'ATCG', 'X': 'ATCG'}
+AMBIGUOUS_RUNS = re.compile("[^ACGT]+")
+# Homopolymers of at least HP_MIN_LEN bases are indexed in the references. Shorter ones are found in the reads
+HP_MIN_LEN = 4
+IS_ACGT = np.zeros(256, dtype=bool)
+IS_ACGT[[ord(x) for x in "ACGT"]] = True
+
+# Row c of RESOLVE_BASES holds the bases IUPAC code c (an ASCII code) can stand for, the first RESOLVE_COUNT[c] of
+# them being valid. Other characters resolve to themselves
+RESOLVE_BASES = np.repeat(np.arange(256, dtype=np.uint8)[:, None], 4, axis=1)
+RESOLVE_COUNT = np.ones(256, dtype=np.int64)
+for code, bases in IUPAC_CODES.items():
+    RESOLVE_BASES[ord(code), :len(bases)] = [ord(x) for x in bases]
+    RESOLVE_COUNT[ord(code)] = len(bases)
+
+
+def run_positions(run_start, run_end):
+    # All positions covered by the sorted runs [run_start[i], run_end[i])
+    lengths = run_end - run_start
+    ends = np.cumsum(lengths)
+    return np.repeat(run_start - ends + lengths, lengths) + np.arange(ends[-1] if len(ends) else 0)
+
+
+def resolve_bases(seq_bases, pos):
+    # Resolve the IUPAC codes at positions pos of the ASCII array seq_bases in place
+    codes = seq_bases[pos]
+    choice = (np.random.random(len(codes)) * RESOLVE_COUNT[codes]).astype(np.int64)
+    seq_bases[pos] = RESOLVE_BASES[codes, choice]
+
+
+def resolve_ambiguous(seq, run_start=None, run_end=None):
+    # Replace each IUPAC code in the uppercase seq with one of its bases chosen at random.
+    # run_start and run_end are the sorted runs of non-ACGT characters in seq, found here if not given
+    if run_start is None:
+        runs = [(m.start(), m.end()) for m in AMBIGUOUS_RUNS.finditer(seq)]
+        if not runs:
+            return seq
+        run_start, run_end = np.array(runs, dtype=np.int64).T
+
+    seq_bases = np.frombuffer(seq.encode(), dtype=np.uint8).copy()
+    resolve_bases(seq_bases, run_positions(run_start, run_end))
+    return seq_bases.tobytes().decode()
+
+
+def overlapping_runs(run_start, run_end, start, stop):
+    # Index range of the sorted runs overlapping [start, stop)
+    return np.searchsorted(run_end, start, side="right"), np.searchsorted(run_start, stop, side="left")
+
+
+def homopolymer_runs(seq, k):
+    # Starts and ends of the runs of at least k identical A, C, G or T in the uppercase seq
+    seq_bases = np.frombuffer(seq.encode(), dtype=np.uint8)
+    if k == 1:
+        edges = np.flatnonzero(seq_bases[1:] != seq_bases[:-1]) + 1
+        starts = np.concatenate(([0], edges))[:len(seq_bases)]
+        ends = np.concatenate((edges, [len(seq_bases)]))[:len(seq_bases)]
+        is_hp = IS_ACGT[seq_bases[starts]]
+        return starts[is_hp].astype(np.int64), ends[is_hp].astype(np.int64)
+
+    # Mark the positions starting k identical bases. Consecutive marks belong to the same run, which ends k - 1 bases
+    # after its last mark
+    num_pos = max(len(seq_bases) - k + 1, 0)
+    marks = IS_ACGT[seq_bases[:num_pos]]
+    for shift in range(1, k):
+        marks &= seq_bases[shift: shift + num_pos] == seq_bases[:num_pos]
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], marks.view(np.int8), [0]))))
+    return edges[0::2].astype(np.int64), edges[1::2].astype(np.int64) + k - 1
+
+
+def window_runs(run_start, run_end, start, stop):
+    # The sorted runs overlapping [start, stop), clipped to it and with offsets from start
+    first, last = overlapping_runs(run_start, run_end, start, stop)
+    return np.maximum(run_start[first: last], start) - start, np.minimum(run_end[first: last], stop) - start
+
+
+class fragment(str):
+    # A sequence with the starts and ends of the indexed homopolymers (of at least HP_MIN_LEN bases) in it
+    def __new__(cls, seq, hp_runs):
+        obj = str.__new__(cls, seq)
+        obj.hp_runs = hp_runs
+        return obj
+
+
+def homopolymers(seq, k):
+    # Starts and ends of the homopolymers of at least k bases in seq, taken from the index for fragments
+    if isinstance(seq, fragment) and k >= HP_MIN_LEN:
+        hp_start, hp_end = seq.hp_runs
+        long_enough = hp_end - hp_start >= k
+        return hp_start[long_enough], hp_end[long_enough]
+    return homopolymer_runs(seq, k)
+
+
+class ref_seq(object):
+    # An uppercase reference sequence, the runs of non-ACGT characters in it and its homopolymers. Slicing returns
+    # the fragment with the ambiguous bases inside it resolved at random, so every read sees a new resolution
+    def __init__(self, seq):
+        self.seq = seq.upper()
+        runs = [(m.start(), m.end()) for m in AMBIGUOUS_RUNS.finditer(self.seq)]
+        self.run_start = np.array([x[0] for x in runs], dtype=np.int64)
+        self.run_end = np.array([x[1] for x in runs], dtype=np.int64)
+        self.hp_start, self.hp_end = homopolymer_runs(self.seq, HP_MIN_LEN)
+
+    def __len__(self):
+        return len(self.seq)
+
+    def __getitem__(self, key):
+        start, stop, step = key.indices(len(self.seq))
+        seq = self.seq[start: stop]
+        if len(self.run_start) > 0 and stop > start:
+            first, last = overlapping_runs(self.run_start, self.run_end, start, stop)
+            if first < last:
+                run_start = np.maximum(self.run_start[first: last], start) - start
+                run_end = np.minimum(self.run_end[first: last], stop) - start
+                seq = resolve_ambiguous(seq, run_start, run_end)
+        return fragment(seq, window_runs(self.hp_start, self.hp_end, start, stop))
+
+
+# Packed references are stored next to the FASTA file as <fasta>.nsref:
+#   magic (8 bytes), offset of the contig table (uint64)
+#   for each contig: bases packed 4 per byte (A, C, G, T as 0-3, most significant bits first, non-ACGT as A),
+#                    then the runs of identical non-ACGT characters as int64 starts, int64 ends and uint8 characters,
+#                    then the homopolymers of at least HP_MIN_LEN bases as int64 starts and int64 ends
+#   contig table: JSON with the size and modification time of the FASTA file, and for each contig its name, length,
+#                 offset of the packed bases, offset of the runs, number of runs, offset of the homopolymers and
+#                 number of homopolymers
+# Each section starts at a multiple of 8 bytes.
+PACKED_SUFFIX = ".nsref"
+PACKED_MAGIC = b"NSREF\x00\x00\x02"
+PACK_CODES = np.zeros(256, dtype=np.uint8)
+for code, base in enumerate("ACGT"):
+    PACK_CODES[ord(base)] = code
+    PACK_CODES[ord(base.lower())] = code
+UNPACK_BASES = np.array([[ord("ACGT"[(byte >> shift) & 3]) for shift in (6, 4, 2, 0)] for byte in range(256)],
+                        dtype=np.uint8)
+SAME_AMBIGUOUS_RUNS = re.compile(r"([^ACGT])\1*")
+
+
+class packed_ref_seq(object):
+    # A reference sequence in a memory mapped packed reference, sliced like ref_seq
+    def __init__(self, packed, length, run_start, run_end, run_code, hp_start, hp_end):
+        self.packed = packed
+        self.length = length
+        self.run_start = run_start
+        self.run_end = run_end
+        self.run_code = run_code
+        self.hp_start = hp_start
+        self.hp_end = hp_end
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, key):
+        start, stop, step = key.indices(self.length)
+        if stop <= start:
+            return fragment("", window_runs(self.hp_start, self.hp_end, start, start))
+        shift = start % 4
+        seq_bases = UNPACK_BASES[self.packed[start // 4: (stop + 3) // 4]].ravel()[shift: shift + stop - start]
+
+        first, last = overlapping_runs(self.run_start, self.run_end, start, stop)
+        if first < last:
+            run_start = np.maximum(self.run_start[first: last], start) - start
+            run_end = np.minimum(self.run_end[first: last], stop) - start
+            pos = run_positions(run_start, run_end)
+            seq_bases[pos] = np.repeat(self.run_code[first: last], run_end - run_start)
+            resolve_bases(seq_bases, pos)
+        return fragment(seq_bases.tobytes().decode(), window_runs(self.hp_start, self.hp_end, start, stop))
+
+
+def packed_path(fasta):
+    return fasta + PACKED_SUFFIX
+
+
+def write_packed(fasta, records):
+    # Pack the (name, sequence) records read from fasta. The file is written under a temporary name and renamed, so
+    # an interrupted run never leaves a truncated packed reference behind
+    out_path = packed_path(fasta)
+    tmp_path = out_path + ".tmp" + str(os.getpid())
+    try:
+        contigs = []
+        with open(tmp_path, "wb") as out_file:
+            out_file.write(PACKED_MAGIC + struct.pack("<Q", 0))
+            for name, seq in records:
+                seq = seq.upper()
+                seq_bases = np.frombuffer(seq.encode(), dtype=np.uint8)
+                codes = np.zeros((len(seq_bases) + 3) // 4 * 4, dtype=np.uint8)
+                codes[:len(seq_bases)] = PACK_CODES[seq_bases]
+                codes = codes.reshape(-1, 4)
+                packed = (codes[:, 0] << 6) | (codes[:, 1] << 4) | (codes[:, 2] << 2) | codes[:, 3]
+                seq_offset = out_file.tell()
+                write_aligned(out_file, packed.tobytes())
+
+                runs = [(m.start(), m.end(), ord(m.group(1))) for m in SAME_AMBIGUOUS_RUNS.finditer(seq)]
+                runs = np.array(runs, dtype=np.int64).reshape(-1, 3)
+                run_offset = out_file.tell()
+                write_aligned(out_file, runs[:, 0].tobytes() + runs[:, 1].tobytes() +
+                              runs[:, 2].astype(np.uint8).tobytes())
+
+                hp_start, hp_end = homopolymer_runs(seq, HP_MIN_LEN)
+                hp_offset = out_file.tell()
+                write_aligned(out_file, hp_start.tobytes() + hp_end.tobytes())
+                contigs.append([name, len(seq), seq_offset, run_offset, len(runs), hp_offset, len(hp_start)])
+
+            table_offset = out_file.tell()
+            fasta_stat = os.stat(fasta)
+            out_file.write(json.dumps({"size": fasta_stat.st_size, "mtime": fasta_stat.st_mtime,
+                                       "contigs": contigs}).encode())
+            out_file.seek(len(PACKED_MAGIC))
+            out_file.write(struct.pack("<Q", table_offset))
+        os.rename(tmp_path, out_path)
+    except (IOError, OSError):
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def write_aligned(out_file, data):
+    out_file.write(data + b"\x00" * (-len(data) % 8))
+
+
+def open_packed(fasta):
+    # Return the (name, packed_ref_seq) records of the packed copy of fasta, or None if there is no up-to-date one
+    in_path = packed_path(fasta)
+    if not os.path.isfile(in_path):
+        return None
+    with open(in_path, "rb") as in_file:
+        if in_file.read(len(PACKED_MAGIC)) != PACKED_MAGIC:
+            return None
+        table_offset = struct.unpack("<Q", in_file.read(8))[0]
+        if table_offset == 0:
+            return None
+        in_file.seek(table_offset)
+        table = json.loads(in_file.read().decode())
+        fasta_stat = os.stat(fasta)
+        if table["size"] != fasta_stat.st_size or table["mtime"] != fasta_stat.st_mtime:
+            return None
+        # Workers forked afterwards share the mapping, and the pages through the page cache
+        packed_map = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    packed_bytes = np.frombuffer(packed_map, dtype=np.uint8)
+    records = []
+    for name, length, seq_offset, run_offset, num_runs, hp_offset, num_hp in table["contigs"]:
+        runs = packed_bytes[run_offset: run_offset + 16 * num_runs].view(np.int64)
+        run_code = packed_bytes[run_offset + 16 * num_runs: run_offset + 17 * num_runs]
+        hp_runs = packed_bytes[hp_offset: hp_offset + 16 * num_hp].view(np.int64)
+        records.append((name, packed_ref_seq(packed_bytes[seq_offset: seq_offset + (length + 3) // 4], length,
+                                             runs[:num_runs], runs[num_runs:], run_code, hp_runs[:num_hp],
+                                             hp_runs[num_hp:])))
+    return records
+
+
+class position_sampler(object):
+    # Draw the contig and start position of a read uniformly among all positions where it fits entirely in a contig,
+    # as if contigs were joined and positions crossing a contig end rejected. Contigs are sorted by decreasing length,
+    # so those long enough for a read are a prefix, and positions are counted with a cumulative length array.
+    # Circular contigs (names in circular) hold a read at each of their positions, the read crossing their origin
+    def __init__(self, seq_len, circular=()):
+        self.names = sorted(seq_len, key=lambda x: -seq_len[x])
+        self.lengths = np.array([seq_len[x] for x in self.names], dtype=np.int64)
+        self.cum_len = np.concatenate(([0], np.cumsum(self.lengths))).tolist()
+        self.cum_linear = np.concatenate(([0], np.cumsum([x not in circular for x in self.names]))).tolist()
+        self.neg_lengths = -self.lengths
+        self.max_len = int(self.lengths[0]) if len(self.lengths) else 0
+
+    def sample(self, length):
+        # The first i contigs hold cum_len[i] - cum_linear[i] * (length - 1) start positions
+        num_contigs = int(np.searchsorted(self.neg_lengths, -length, side="right"))
+        if num_contigs == 0:
+            raise ValueError("No contig is long enough for a read of length " + str(length))
+        overlap = length - 1
+        pos = random.randint(0, self.cum_len[num_contigs] - self.cum_linear[num_contigs] * overlap - 1)
+        low = 0
+        high = num_contigs
+        while high - low > 1:
+            mid = (low + high) // 2
+            if self.cum_len[mid] - self.cum_linear[mid] * overlap <= pos:
+                low = mid
+            else:
+                high = mid
+        return self.names[low], pos - (self.cum_len[low] - self.cum_linear[low] * overlap)
+
+
+class species_sampler(object):
+    # Draw the contig and start position of a read in a species with a position_sampler per species. Species are
+    # sorted by decreasing longest contig, so those able to hold a read are a prefix. seq_len and dna_type are the
+    # contig lengths and types (linear or circular) by species
+    def __init__(self, seq_len, dna_type):
+        self.samplers = {}
+        for species in seq_len:
+            self.samplers[species] = position_sampler(seq_len[species], set(x for x in seq_len[species]
+                                                                            if dna_type[species][x] == "circular"))
+        self.species = sorted(seq_len, key=lambda x: -self.samplers[x].max_len)
+        self.neg_max_len = np.array([-self.samplers[x].max_len for x in self.species], dtype=np.int64)
+
+    def sample(self, length, species=None):
+        # Returns the species, contig and start position. The read is drawn in species, or in a species chosen at
+        # random among those able to hold it if species is None or cannot hold it
+        if species is None or length > self.samplers[species].max_len:
+            num_species = int(np.searchsorted(self.neg_max_len, -length, side="right"))
+            if num_species == 0:
+                raise ValueError("No contig is long enough for a read of length " + str(length))
+            species = self.species[random.randint(0, num_species - 1)]
+        name, pos = self.samplers[species].sample(length)
+        return species, name, pos
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+"""
+This script provides the per-read sequence operations of simulator.py: random bases for the head and tail of reads,
+drawn with one integer draw and a byte table lookup, and reverse complements and thymine to uracil conversions, done
+with str.translate in a single pass
+"""
+
+import numpy as np
+
+
+# Random bases are drawn as indices in RANDOM_BASES, in the order of simulator.BASES, so that a draw of n bases takes
+# the same random numbers as np.random.choice(BASES, n)
+RANDOM_BASES = np.frombuffer(b"ATCG", dtype=np.uint8)
+
+# Translation tables by uracil, other characters than ACGT being left as they are
+COMPLEMENT = {False: str.maketrans("ACGT", "TGCA"), True: str.maketrans("ACGT", "UGCA")}
+URACIL = str.maketrans("T", "U")
+
+
+def random_bases(n):
+    return RANDOM_BASES[np.random.randint(0, len(RANDOM_BASES), n)].tobytes().decode()
+
+
+def random_bases_batch(lengths):
+    # Random sequences of the given lengths, from a single draw
+    bases = random_bases(sum(lengths))
+    seqs = []
+    start = 0
+    for length in lengths:
+        seqs.append(bases[start: start + length])
+        start += length
+    return seqs
+
+
+def reverse_complement(seq, uracil=False):
+    return seq.translate(COMPLEMENT[uracil])[::-1]
+
+
+def orient(seq, reverse, uracil=False):
+    # seq as written to the reads: reverse complemented if reverse, and with T turned into U if uracil
+    if reverse:
+        return reverse_complement(seq, uracil)
+    if uracil:
+        return seq.translate(URACIL)
+    return seq
@@ -15,6 +15,7 @@ import os
 import HTSeq
 import pysam
 import random
+import bisect
 import re
 import copy
 import argparse
@@ -25,19 +26,22 @@ from gzip import GzipFile
 import numpy as np
 import scipy.stats
 
-if sys.version_info[0] < 3:
-    from string import maketrans
-    trantab = maketrans("T", "U")
-else:
-    trantab = str.maketrans("T", "U")
-
 try:
     from six.moves import xrange
 except ImportError:
     pass
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
 import mixed_model as mm
 import norm_distr as nd
-import math
+import reference as rf
+import file_handler as fh
+import error_profile as ep
+import truth as tr
+import performance as pf
+import sequence as sq
 
 PYTHON_VERSION = sys.version_info
 VERSION = "3.0.0"
@@ -46,32 +50,28 @@ AUTHOR = "Chen Yang, Saber Hafezqorani, Theodora Lo (UBC & BCGSC)"
 CONTACT = "cheny@bcgsc.ca; shafezqorani@bcgsc.ca"
 
 BASES = ['A', 'T', 'C', 'G']
-
-
-def select_ref_transcript(input_dict):
-    length = 0
-    while True:
-        p = random.random()
-        for key, val in input_dict.items():
-            if key[0] <= p < key[1]:
-                length = val[1]
-                break
-        if length != 0:
-            break
-    return val[0], length
-
-
-def list_to_range(input_list, min_l):
-    l = [min_l]
-    l.extend(input_list)
-    output_list = []
-    for i in xrange(0, len(l) - 1):
-        r = (l[i], l[i + 1])
-        output_list.append(r)
-    return output_list
+ERROR_STATES = ["start", "mis", "ins", "del", "mis0", "ins0", "del0"]
+BASE_CODES = np.frombuffer(''.join(BASES).encode(), dtype=np.uint8)
+# MIS_SUBS[b] are the three bases a mismatch can turn base b into, b being an ASCII code
+MIS_SUBS = np.array([[ord(x) for x in [y for y in BASES if ord(y) != b][:3]] for b in range(256)], dtype=np.uint8)
+# BASE_INDEX[b] is the index in BASES of base b, an ASCII code
+BASE_INDEX = np.zeros(256, dtype=np.int64)
+BASE_INDEX[BASE_CODES] = np.arange(len(BASES))
+# Reads are simulated in batches of BATCH_SIZE (by default) handed out to the worker processes as they become free
+BATCH_SIZE = 1000
+# Minimum number of 2D aligned length samples to pair transcripts with, so that small batches are paired as finely as
+# large ones
+KDE_2D_SAMPLES = 10000
+
+
+def select_ref_transcript(input_cdf, n):
+    # Draw n transcripts according to their expression, returns their indices in the lists of make_cdf
+    cdf = input_cdf[0]
+    return np.minimum(np.searchsorted(cdf, np.random.random(n), side="right"), len(cdf) - 1)
 
 
 def make_cdf(dict_exp, dict_len):
+    # Returns the cumulative expression of transcripts as an array, and the matching transcript ids and lengths (array)
     sum_exp = 0
     list_value = []
     for item in dict_exp:
@@ -83,17 +83,11 @@ def make_cdf(dict_exp, dict_len):
             list_value.append((item, value))
 
     sorted_value_list = sorted(list_value, key=lambda x: x[1])
-    sorted_only_values = [x[1] for x in sorted_value_list]
-    list_cdf = np.cumsum(sorted_only_values)
-    ranged_cdf_list = list_to_range(list_cdf, 0)
-
-    ecdf_dict = {}
-    for i in xrange(len(ranged_cdf_list)):
-        cdf_range = ranged_cdf_list[i]
-        ecdf_dict[cdf_range] = (sorted_value_list[i][0], dict_len[sorted_value_list[i][0]])
-        # ecdf_dict[cdf_range] = dict_len[sorted_value_list[i][0]]
+    list_cdf = np.cumsum([x[1] for x in sorted_value_list])
+    list_ids = [x[0] for x in sorted_value_list]
+    list_len = np.array([dict_len[x] for x in list_ids], dtype=np.int64)
 
-    return ecdf_dict
+    return list_cdf, list_ids, list_len
 
 
 def ref_len_from_structure(input):
@@ -104,10 +98,26 @@ def ref_len_from_structure(input):
     return l
 
 
-def select_nearest_kde2d(sampled_2d_lengths, ref_len_total):
+def index_kde2d(sampled_2d_lengths):
+    # Sorted distinct reference lengths of the 2D samples, and the aligned length of the first sample having each
     fc = sampled_2d_lengths[:, 0]
-    idx = np.abs(fc - ref_len_total).argmin()
-    return int(sampled_2d_lengths[idx][1])
+    fc_values, fc_inverse = np.unique(fc, return_inverse=True)
+    first_idx = np.full(len(fc_values), len(fc), dtype=np.int64)
+    np.minimum.at(first_idx, fc_inverse, np.arange(len(fc)))
+    return fc_values, first_idx, sampled_2d_lengths[:, 1].astype(np.int64)
+
+
+def select_nearest_kde2d(kde2d_index, ref_len_list):
+    # For each reference length, the aligned length of the 2D sample with the nearest reference length, the first
+    # sample in case of ties, same as argmin over all samples
+    fc_values, first_idx, aligned = kde2d_index
+    ref_len_list = np.asarray(ref_len_list)
+    right = np.minimum(np.searchsorted(fc_values, ref_len_list, side="left"), len(fc_values) - 1)
+    left = np.maximum(right - 1, 0)
+    dist_left = np.abs(fc_values[left] - ref_len_list)
+    dist_right = np.abs(fc_values[right] - ref_len_list)
+    use_left = (dist_left < dist_right) | ((dist_left == dist_right) & (first_idx[left] < first_idx[right]))
+    return aligned[np.where(use_left, first_idx[left], first_idx[right])]
 
 
 def update_structure(ref_trx_structure, IR_markov_model):
@@ -121,14 +131,14 @@ def update_structure(ref_trx_structure, IR_markov_model):
     prev_state = "start"
     for i in range(0, count):
         p = random.random()
-        for key in IR_markov_model[prev_state]:
-            if key[0] <= p < key[1]:
-                flag = IR_markov_model[prev_state][key]
-                if flag == "IR":
-                    flag_ir = True
-                list_states.append(flag)
-                prev_state = flag
-                break
+        no_ir, ir = IR_markov_model[prev_state]
+        if no_ir <= p < ir:
+            flag = "IR"
+            flag_ir = True
+        else:
+            flag = "no_IR"
+        list_states.append(flag)
+        prev_state = flag
 
     if flag_ir:
         ref_trx_structure_temp = copy.deepcopy(ref_trx_structure)
@@ -193,16 +203,18 @@ def extract_read_pos(length, ref_len, ref_trx_structure, polya, buffer=10):
 def read_ecdf(profile):
     # We need to count the number of zeros. If it's over 10 zeros, l_len/l_ratio need to be changed to higher.
     # Because it's almost impossible that the ratio is much lower than the lowest historical value.
+    # The ecdf of each bin is a list of probability intervals and the value intervals they map to. All bins are
+    # flattened into sorted arrays, so that whole arrays of uniforms can be looked up with one searchsorted call;
+    # cumulative probabilities of bin i are shifted by 2 * i to keep them in a single sorted array.
     header = profile.readline()
     header_info = header.strip().split()
-    ecdf_dict = {}
     lanes = len(header_info[1:])
 
-    for i in header_info[1:]:
-        boundaries = i.split('-')
-        ecdf_dict[(int(boundaries[0])), int(boundaries[1])] = {}
-
-    ecdf_key = sorted(ecdf_dict.keys())
+    bin_low = sorted(int(i.split('-')[0]) for i in header_info[1:])
+    prob_low = [[] for i in xrange(lanes)]
+    prob_high = [[] for i in xrange(lanes)]
+    value_low = [[] for i in xrange(lanes)]
+    value_high = [[] for i in xrange(lanes)]
     l_prob = [0.0] * lanes
     l_ratio = [0.0] * lanes
 
@@ -214,22 +226,37 @@ def read_ecdf(profile):
             if prob[i] == l_prob[i]:
                 continue
             else:
+                prob_low[i].append(l_prob[i])
+                prob_high[i].append(prob[i] + 2 * i)
+                value_high[i].append(ratio[1])
                 if l_prob[i] != 0:
-                    ecdf_dict[ecdf_key[i]][(l_prob[i], prob[i])] = (l_ratio[i], ratio[1])
+                    value_low[i].append(l_ratio[i])
                 else:
-                    ecdf_dict[ecdf_key[i]][(l_prob[i], prob[i])] \
-                        = (max(l_ratio[i], ratio[1] - 10 * (ratio[1] - ratio[0])), ratio[1])
+                    value_low[i].append(max(l_ratio[i], ratio[1] - 10 * (ratio[1] - ratio[0])))
                 l_ratio[i] = ratio[1]
                 l_prob[i] = prob[i]
 
-    for i in xrange(0, len(ecdf_key)):
-        last_key = sorted(ecdf_dict[ecdf_key[i]].keys())[-1]
-        last_value = ecdf_dict[ecdf_key[i]][last_key]
-        ecdf_dict[ecdf_key[i]][last_key] = (last_value[0], ratio[1])
+    for i in xrange(0, lanes):
+        value_high[i][-1] = ratio[1]
+
+    bin_end = np.cumsum([len(x) for x in prob_high])
+    return np.array(bin_low), bin_end, np.concatenate(prob_low), np.concatenate(prob_high), \
+        np.concatenate(value_low), np.concatenate(value_high)
+
 
-    return ecdf_dict
+def ecdf_lookup(ecdf, prev, p):
+    # Draw from an ecdf of read_ecdf: prev selects the bin, p are uniforms in [0, 1). Works on arrays and scalars
+    bin_low, bin_end, prob_low, prob_high, value_low, value_high = ecdf
+    bins = np.searchsorted(bin_low, prev, side="right") - 1
+    bins = np.clip(bins, 0, len(bin_low) - 1)
+    idx = np.minimum(np.searchsorted(prob_high, p + 2 * bins), bin_end[bins] - 1)
+    p_low = prob_low[idx]
+    p_high = prob_high[idx] - 2 * bins
+    return np.floor((p - p_low) / (p_high - p_low) * (value_high[idx] - value_low[idx]) +
+                    value_low[idx]).astype(np.int64)
 
 
+@pf.timed("length_sampling")
 def get_length_kde(kde, num, log=False, flatten=True):
     tmp_list = kde.sample(num)
     if log:
@@ -241,20 +268,21 @@ def get_length_kde(kde, num, log=False, flatten=True):
         return length_list
 
 
+@pf.timed("model_load")
 def read_profile(ref_g, number_list, model_prefix, per, mode, strandness, ref_t=None, dna_type=None, abun=None,
                  polya=None, exp=None, model_ir=False, chimeric=False):
     # Note var number_list (list) used to be number (int)
     global number_aligned_l, number_unaligned_l, number_segment_list
-    global match_ht_list, error_par, trans_error_pr, match_markov_model
+    global match_ht_list, error_par, error_samplers, trans_error_pr, match_markov_model
     global kde_aligned, kde_ht, kde_ht_ratio, kde_unaligned, kde_aligned_2d
-    global seq_dict, seq_len, max_chrom
+    global seq_dict, seq_len, ref_names, max_chrom
     global strandness_rate
 
     if mode == "genome":
-        global genome_len
+        global genome_len, genome_sampler
         ref = ref_g
     elif mode == "metagenome":
-        global multi_dict_abun, dict_dna_type
+        global multi_dict_abun, dict_dna_type, metagenome_sampler
         ref = {}
         with open(ref_g, 'r') as genome_list:
             list = genome_list.readlines()
@@ -278,15 +306,18 @@ def read_profile(ref_g, number_list, model_prefix, per, mode, strandness, ref_t=
     sys.stdout.flush()
     seq_dict = {}
     seq_len = {}
+    ref_names = {}  # Names of the references in the input files, which the keys of seq_dict are derived from
     dict_dna_type = {}
 
     # Read in the reference genome/transcriptome/metagenome
+    pf.stats.start("reference_load")
     if mode == "metagenome":
         max_chrom = {}
         for species in ref.keys():
             fq_path = ref[species]
             seq_dict[species] = {}
             seq_len[species] = {}
+            ref_names[species] = {}
             dict_dna_type[species] = {}
             max_chrom[species] = 0
 
@@ -305,22 +336,25 @@ def read_profile(ref_g, number_list, model_prefix, per, mode, strandness, ref_t=
                             chr_name = "-".join(info[1:])
                             seq_dict[species][chr_name.split(".")[0]] = ''
                             seq_len[species][chr_name.split(".")[0]] = 0
+                            ref_names[species][chr_name.split(".")[0]] = line[1:].split()[0]
                             dict_dna_type[species][chr_name.split(".")[0]] = "linear"  # linear as default
                         else:
                             seq_dict[species][chr_name.split(".")[0]] += line
                             seq_len[species][chr_name.split(".")[0]] += len(line)
                             if seq_len[species][chr_name.split(".")[0]] > max_chrom[species]:
                                 max_chrom[species] = seq_len[species][chr_name.split(".")[0]]
+                for chr_name in seq_dict[species]:
+                    seq_dict[species][chr_name] = rf.ref_seq(seq_dict[species][chr_name])
             else:
-                with open(fq_path, 'r') as infile:
-                    for seqN, seqS, seqQ in readfq(infile):
-                        info = re.split(r'[_\s]\s*', seqN)
-                        chr_name = "-".join(info)
-                        seq_dict[species][chr_name.split(".")[0]] = seqS
-                        seq_len[species][chr_name.split(".")[0]] = len(seqS)
-                        dict_dna_type[species][chr_name.split(".")[0]] = "circular"  # circular as default
-                        if len(seqS) > max_chrom[species]:
-                            max_chrom[species] = len(seqS)
+                for seqN, seqS, seqQ in read_reference(fq_path):
+                    info = re.split(r'[_\s]\s*', seqN)
+                    chr_name = "-".join(info)
+                    seq_dict[species][chr_name.split(".")[0]] = seqS
+                    seq_len[species][chr_name.split(".")[0]] = len(seqS)
+                    ref_names[species][chr_name.split(".")[0]] = seqN
+                    dict_dna_type[species][chr_name.split(".")[0]] = "circular"  # circular as default
+                    if len(seqS) > max_chrom[species]:
+                        max_chrom[species] = len(seqS)
 
         with open(dna_type, 'r') as dna_type_list:
             for line in dna_type_list.readlines():
@@ -336,22 +370,25 @@ def read_profile(ref_g, number_list, model_prefix, per, mode, strandness, ref_t=
                 dict_dna_type[species][chr_name.split(".")[0]] = type
     else:
         max_chrom = 0
-        with open(ref, 'r') as infile:
-            for seqN, seqS, seqQ in readfq(infile):
-                info = re.split(r'[_\s]\s*', seqN)
-                chr_name = "-".join(info)
-                seq_dict[chr_name.split(".")[0]] = seqS
-                seq_len[chr_name.split(".")[0]] = len(seqS)
-                if len(seqS) > max_chrom:
-                    max_chrom = len(seqS)
+        for seqN, seqS, seqQ in read_reference(ref):
+            info = re.split(r'[_\s]\s*', seqN)
+            chr_name = "-".join(info)
+            seq_dict[chr_name.split(".")[0]] = seqS
+            seq_len[chr_name.split(".")[0]] = len(seqS)
+            ref_names[chr_name.split(".")[0]] = seqN
+            if len(seqS) > max_chrom:
+                max_chrom = len(seqS)
+    pf.stats.stop()
 
     # Special files for each mode
     if mode == "genome":
         genome_len = sum(seq_len.values())
+        genome_sampler = rf.position_sampler(seq_len)
         if len(seq_dict) > 1 and dna_type == "circular":
             sys.stderr.write("Do not choose circular if there is more than one chromosome in the genome!\n")
             sys.exit(1)
     elif mode == "metagenome":
+        metagenome_sampler = rf.species_sampler(seq_len, dict_dna_type)
         sys.stdout.write(strftime("%Y-%m-%d %H:%M:%S") + ": Read in abundance profile\n")
         sys.stdout.flush()
         with open(abun, 'r') as abun_file:
@@ -392,7 +429,7 @@ def read_profile(ref_g, number_list, model_prefix, per, mode, strandness, ref_t=
         ecdf_dict_ref_exp = make_cdf(dict_exp, seq_len)
 
         if model_ir:
-            global genome_fai, IR_markov_model, dict_ref_structure
+            global genome_fai, IR_markov_model, dict_ref_structure, trx_in_structure
             sys.stdout.write(strftime("%Y-%m-%d %H:%M:%S") + ": Read in reference genome and create .fai index file\n")
             sys.stdout.flush()
             # create and read the .fai file of the reference genome
@@ -401,15 +438,14 @@ def read_profile(ref_g, number_list, model_prefix, per, mode, strandness, ref_t=
             sys.stdout.write(strftime("%Y-%m-%d %H:%M:%S") + ": Read in IR markov model\n")
             sys.stdout.flush()
 
+            # IR is chosen when no_IR <= p < no_IR + IR
             IR_markov_model = {}
             with open(model_prefix + "_IR_markov_model", "r") as IR_markov:
                 IR_markov.readline()
                 for line in IR_markov:
                     info = line.strip().split()
                     k = info[0]
-                    IR_markov_model[k] = {}
-                    IR_markov_model[k][(0, float(info[1]))] = "no_IR"
-                    IR_markov_model[k][(float(info[1]), float(info[1]) + float(info[2]))] = "IR"
+                    IR_markov_model[k] = (float(info[1]), float(info[1]) + float(info[2]))
 
             sys.stdout.write(strftime("%Y-%m-%d %H:%M:%S") + ": Read in GFF3 annotation file\n")
             sys.stdout.flush()
@@ -443,6 +479,13 @@ def read_profile(ref_g, number_list, model_prefix, per, mode, strandness, ref_t=
                     dict_ref_structure[feature_id].append((feature.type, feature.iv.chrom, feature.iv.start,
                                                            feature.iv.end, feature.iv.length, feature.iv.strand))
 
+            # Only transcripts whose structure matches their sequence can be used
+            trx_ids = ecdf_dict_ref_exp[1]
+            trx_lengths = ecdf_dict_ref_exp[2]
+            trx_in_structure = np.array([trx_ids[i] in dict_ref_structure and
+                                         ref_len_from_structure(dict_ref_structure[trx_ids[i]]) == trx_lengths[i]
+                                         for i in xrange(len(trx_ids))], dtype=bool)
+
         if polya:
             global trx_with_polya
             sys.stdout.write(strftime("%Y-%m-%d %H:%M:%S") + ": Read in list of transcripts with polyA tails\n")
@@ -456,6 +499,7 @@ def read_profile(ref_g, number_list, model_prefix, per, mode, strandness, ref_t=
     if per:  # if parameter perfect is used, all reads should be aligned, number_aligned equals total number of reads
         number_aligned_l = number_list
         number_unaligned_l = [0] * len(number_list)
+        error_samplers = {}
     else:
         # Read model profile for match, mismatch, insertion and deletions
         sys.stdout.write(strftime("%Y-%m-%d %H:%M:%S") + ": Read error profile\n")
@@ -474,16 +518,21 @@ def read_profile(ref_g, number_list, model_prefix, per, mode, strandness, ref_t=
                 else:
                     error_par["del"] = [float(x) for x in new_line[1:]]
 
-        trans_error_pr = {}
+        # Error lengths of unaligned reads and gaps are drawn one at a time, so serve them from pre-drawn blocks
+        error_samplers = {"mis": mm.buffered_rvs(mm.pois_geom_rvs, [error_par["mis"][0]] + error_par["mis"][2:4]),
+                          "ins": mm.buffered_rvs(mm.wei_geom_rvs, error_par["ins"][0:4]),
+                          "del": mm.buffered_rvs(mm.wei_geom_rvs, error_par["del"][0:4])}
+
+        # Row i of the error Markov chain is state ERROR_STATES[i], the columns are the cumulative probabilities of
+        # mis and mis + ins, the rest being del
+        trans_error_pr = np.zeros((len(ERROR_STATES), 2))
         with open(model_prefix + "_error_markov_model", "r") as error_markov:
             error_markov.readline()
             for line in error_markov:
                 info = line.strip().split()
-                k = info[0]
-                trans_error_pr[k] = {}
-                trans_error_pr[k][(0, float(info[1]))] = "mis"
-                trans_error_pr[k][(float(info[1]), float(info[1]) + float(info[2]))] = "ins"
-                trans_error_pr[k][(1 - float(info[3]), 1)] = "del"
+                k = ERROR_STATES.index(info[0])
+                trans_error_pr[k][0] = float(info[1])
+                trans_error_pr[k][1] = float(info[1]) + float(info[2])
 
         with open(model_prefix + "_first_match.hist", 'r') as fm_profile:
             match_ht_list = read_ecdf(fm_profile)
@@ -564,95 +613,69 @@ def add_abundance_var(expected_abun, total_len, var_low, var_high):
     return abun_with_var
 
 
-def mutate_homo(seq, base_quals, k, basecaller, read_type):
-    hp_arr = []  # [[base, start, end], ...]
-    hp_length_hist = {}  # {length: {A/T: count, C/G: count} ...}
-    hp_samples = {}  # {length: {A/T: [sample], C/G: [sample]} ...}
-
-    # Finding homopolymers in sequence
-    pattern = "A{" + re.escape(str(k)) + ",}|C{" + re.escape(str(k)) + ",}|G{" + re.escape(
-        str(k)) + ",}|T{" + re.escape(str(k)) + ",}"
-
-    for match in re.finditer(pattern, seq):
-        hp_start = match.start()
-        hp_end = match.end()
-        length = hp_end - hp_start
-        base = match.group()[0]
-        hp_arr.append([base, hp_start, hp_end])
-        if length not in hp_length_hist.keys():
-            hp_length_hist[length] = {"A": 0, "T": 0, "C": 0, "G": 0}
-
-        hp_length_hist[length][base] += 1
-
-    # Obtaining samples from normal distributions
-    for length in hp_length_hist.keys():
-        hp_samples[length] = {}
-        a_mu, a_sigma, t_mu, t_sigma, c_mu, c_sigma, g_mu, g_sigma = nd.get_nd_par(length, read_type, basecaller)
-
-        if hp_length_hist[length]["A"] > 0:
-            hp_samples[length]["A"] = np.random.normal(a_mu, a_sigma, hp_length_hist[length]["A"])
-        if hp_length_hist[length]["T"] > 0:
-            hp_samples[length]["T"] = np.random.normal(t_mu, t_sigma, hp_length_hist[length]["T"])
-        if hp_length_hist[length]["C"] > 0:
-            hp_samples[length]["C"] = np.random.normal(c_mu, c_sigma, hp_length_hist[length]["C"])
-        if hp_length_hist[length]["G"] > 0:
-            hp_samples[length]["G"] = np.random.normal(g_mu, g_sigma, hp_length_hist[length]["G"])
-
-    for length in hp_samples.keys():
-        for base in hp_samples[length].keys():
-            hp_samples[length][base] = [0 if x < 0 else x for x in hp_samples[length][base]]
-
-    # Mutating homopolymers in given sequence
-    last_pos = 0
-    mutated_seq = ""
-    total_hp_size_change = 0
-    mis_rate = nd.get_hpmis_rate(read_type, basecaller)
-    for hp_info in hp_arr:
-        base = hp_info[0]
-        ref_hp_start = hp_info[1]
-        ref_hp_end = hp_info[2]
-
-        size = int(round(hp_samples[ref_hp_end - ref_hp_start][base][-1]))
-        hp_samples[ref_hp_end - ref_hp_start][base] = hp_samples[ref_hp_end - ref_hp_start][base][:-1]
-
-        mutated_hp_with_mis = ""
-        mis_pos = []
-
-        for i in xrange(size):
-            p = random.random()
-            if 0 < p <= mis_rate:
-                tmp_bases = list(BASES)
-                while True:
-                    new_base = random.choice(tmp_bases)
-                    if new_base != base:
-                        break
-                mutated_hp_with_mis += new_base
-                mis_pos.append(i)
-            else:
-                mutated_hp_with_mis += base
-            i += 1
-        mutated_seq = mutated_seq + seq[last_pos: ref_hp_start] + mutated_hp_with_mis
-
-        if len(base_quals) != 0:  # fastq
-            diff = size - (ref_hp_end - ref_hp_start)
-            if diff < 0:  # del, remove quals
-                for i in xrange(abs(diff)):
-                    base_quals.pop(ref_hp_start + total_hp_size_change)
-
-            elif diff > 0:  # ins, add quals
-                ins_quals = mm.trunc_lognorm_rvs("ins", read_type, basecaller, diff).tolist()
-                base_quals = base_quals[:ref_hp_end + total_hp_size_change] + ins_quals + \
-                             base_quals[ref_hp_end + total_hp_size_change:]
-
-            if len(mis_pos) != 0:  # mis, change match quals to mis quals
-                mis_quals = mm.trunc_lognorm_rvs("mis", read_type, basecaller, len(mis_pos)).tolist()
-                for i in zip(mis_pos, mis_quals):
-                    base_quals[ref_hp_start + total_hp_size_change + i[0]] = i[1]
-
-        total_hp_size_change += size - (ref_hp_end - ref_hp_start)
-        last_pos = ref_hp_end
-
-    return mutated_seq + seq[last_pos:], base_quals
+# Means and standard deviations of the sizes of homopolymers, by (read_type, basecaller), as arrays indexed by
+# homopolymer length and base (index in BASES). Rows are filled by hp_size_par the first time their length is met
+hp_size_pars = {}
+
+
+def hp_size_par(hp_len, read_type, basecaller):
+    # The table of hp_size_pars for read_type and basecaller, with the rows of the lengths in hp_len filled
+    key = (read_type, basecaller)
+    max_len = int(hp_len.max())
+    table = hp_size_pars.get(key)
+    if table is None or len(table) <= max_len:
+        new_table = np.full((max_len + 1, len(BASES), 2), np.nan)
+        if table is not None:
+            new_table[:len(table)] = table
+        table = hp_size_pars[key] = new_table
+    for length in np.unique(hp_len[np.isnan(table[hp_len, 0, 0])]).tolist():
+        table[length] = np.reshape(nd.get_nd_par(length, read_type, basecaller), (len(BASES), 2))
+    return table
+
+
+@pf.timed("mutate_homo")
+def mutate_homo(seq, base_quals, k, basecaller, read_type, ref_map):
+    # ref_map gives the reference offset of each base of seq (-1 for inserted bases), and is returned updated for the
+    # mutated sequence: homopolymers are shortened from their end, and lengthened by inserting bases at their end.
+    # The sizes of all homopolymers and their mismatches are drawn at once, and the mutated sequence, ref_map and
+    # base_quals are assembled by repeating each base of seq: once, not at all if cut from a shortened homopolymer,
+    # and as many times as needed for the last base of a lengthened one
+    hp_start, hp_end = rf.homopolymers(seq, k)  # from the reference index if seq comes from mutate_read
+    if len(hp_start) == 0:
+        return seq, base_quals, ref_map
+
+    seq_bases = np.frombuffer(seq.encode(), dtype=np.uint8)
+    hp_len = hp_end - hp_start
+    par = hp_size_par(hp_len, read_type, basecaller)[hp_len, BASE_INDEX[seq_bases[hp_start]]]
+    sizes = np.rint(np.maximum(np.random.normal(par[:, 0], par[:, 1]), 0)).astype(np.int64)
+    change = sizes - hp_len
+    new_start = hp_start + np.cumsum(change) - change  # starts of the homopolymers in the mutated sequence
+
+    repeats = np.ones(len(seq_bases), dtype=np.int64)
+    shortened = change < 0
+    repeats[rf.run_positions(hp_start[shortened] + sizes[shortened], hp_end[shortened])] = 0
+    lengthened = change > 0
+    repeats[hp_end[lengthened] - 1] += change[lengthened]
+    src = np.repeat(np.arange(len(seq_bases)), repeats)
+    ins_pos = rf.run_positions(new_start[lengthened] + hp_len[lengthened], new_start[lengthened] + sizes[lengthened])
+
+    # Mismatches within the mutated homopolymers
+    hp_pos = rf.run_positions(new_start, new_start + sizes)
+    p = np.random.random(len(hp_pos))
+    mis_pos = hp_pos[(p > 0) & (p <= nd.get_hpmis_rate(read_type, basecaller))]
+    new_bases = seq_bases[src]
+    if len(mis_pos) > 0:
+        new_bases[mis_pos] = MIS_SUBS[new_bases[mis_pos], np.random.randint(0, 3, len(mis_pos))]
+    new_map = ref_map[src]
+    new_map[ins_pos] = -1
+
+    if len(base_quals) != 0:  # fastq, inserted and mismatched bases get ins and mis quals
+        quals = np.array(base_quals, dtype=np.int64)[src]
+        quals[ins_pos] = mm.trunc_lognorm_rvs("ins", read_type, basecaller, len(ins_pos))
+        quals[mis_pos] = mm.trunc_lognorm_rvs("mis", read_type, basecaller, len(mis_pos))
+        base_quals = quals.tolist()
+
+    return new_bases.tobytes().decode(), base_quals, new_map
 
 
 # Taken from https://github.com/lh3/readfq
@@ -690,118 +713,263 @@ def readfq(fp):  # this is a generator function
                 break
 
 
-def case_convert(seq):
-    base_code = {'Y': ['C', 'T'], 'R': ['A', 'G'], 'W': ['A', 'T'], 'S': ['G', 'C'], 'K': ['T', 'G'], 'M': ['C', 'A'],
-                 'D': ['A', 'G', 'T'], 'V': ['A', 'C', 'G'], 'H': ['A', 'C', 'T'], 'B': ['C', 'G', 'T'],
-                 'N': ['A', 'T', 'C', 'G'], 'X': ['A', 'T', 'C', 'G']}
-
-    up_string = seq.upper()
-    up_list = list(up_string)
-    for i in xrange(len(up_list)):
-        if up_list[i] in base_code:
-            up_list[i] = random.choice(base_code[up_list[i]])
-    out_seq = ''.join(up_list)
+def read_reference(ref_path):
+    # Like readfq, but the sequences are rf.packed_ref_seq objects mapped from the packed copy of the reference, which
+    # is created on the first run. If it cannot be written, fall back to rf.ref_seq objects in memory
+    records = rf.open_packed(ref_path)
+    if records is None:
+        try:
+            with open(ref_path, 'r') as infile:
+                rf.write_packed(ref_path, ((seqN, seqS) for seqN, seqS, seqQ in readfq(infile)))
+            records = rf.open_packed(ref_path)
+        except (IOError, OSError):
+            sys.stdout.write(strftime("%Y-%m-%d %H:%M:%S") + ": Cannot write " + rf.packed_path(ref_path) +
+                             ", keep the reference in memory\n")
+            sys.stdout.flush()
 
-    return out_seq
+    if records is None:
+        with open(ref_path, 'r') as infile:
+            for seqN, seqS, seqQ in readfq(infile):
+                yield seqN, rf.ref_seq(seqS), seqQ
+    else:
+        for seqN, seqS in records:
+            yield seqN, seqS, None
 
 
-def assign_species(length_list, seg_list, current_species_base_dict):
-    # Deal with chimeric reads first
+def case_convert(seq):
+    # Change lowercase to uppercase and replace IUPAC codes with any of their bases. Sequences extracted from seq_dict
+    # are already converted by the reference
+    return rf.resolve_ambiguous(seq.upper())
+
+
+class species_quota(object):
+    # Remaining base quota of each species, with the species kept sorted by decreasing quota, so that those with a
+    # quota over a length are a prefix found by bisection. Ties are sorted by the order of the species in base_quota
+    def __init__(self, base_quota):
+        self.names = list(base_quota)
+        self.index = {species: i for i, species in enumerate(self.names)}
+        self.quota = [base_quota[x] for x in self.names]
+        self.keys = sorted((-q, i) for i, q in enumerate(self.quota))
+
+    def remaining(self, species):
+        return self.quota[self.index[species]]
+
+    def choice(self, length, exclude=None):
+        # A species with a quota over length other than exclude, chosen uniformly, or None if there is none
+        num_species = bisect.bisect_left(self.keys, (-length,))
+        skip = num_species
+        if exclude is not None and self.remaining(exclude) > length:
+            i = self.index[exclude]
+            skip = bisect.bisect_left(self.keys, (-self.quota[i], i))
+            num_species -= 1
+        if num_species <= 0:
+            return None
+        pick = random.randint(0, num_species - 1)
+        if pick >= skip:
+            pick += 1
+        return self.names[self.keys[pick][1]]
+
+    def take(self, species, length):
+        i = self.index[species]
+        del self.keys[bisect.bisect_left(self.keys, (-self.quota[i], i))]
+        self.quota[i] -= length
+        bisect.insort(self.keys, (-self.quota[i], i))
+
+
+def order_segments(length_list, seg_list):
+    # The lengths of the segments and the numbers of segments of the reads, in the order species are assigned to them:
+    # chimeric reads first, then the non-chimeric reads by decreasing length to fit in species quotas better. Only the
+    # reads whose segments all have a length are kept
     seg_list_sorted = sorted(seg_list, reverse=True)
     segs_chimera = sum([x for x in seg_list if x > 1])
-
-    # Sort lengths for non-chimeras to fit in species quota better
     length_list_nonchimera = length_list[segs_chimera:]
     length_list_sorted = length_list[:segs_chimera] + sorted(length_list_nonchimera, reverse=True)
 
-    species_list = [''] * len(length_list)
-    bases_to_add = sum(length_list)
-    current_bases = sum(current_species_base_dict.values())
-    total_bases = bases_to_add + current_bases
+    num_segments = 0
+    for seg in seg_list_sorted:
+        if num_segments + seg > len(length_list_sorted):
+            break
+        num_segments += seg
+    return length_list_sorted[:num_segments], np.array(seg_list_sorted[:num_segments])
 
-    base_quota = {}
-    total_abun = sum(dict_abun.values())
-    for species, abun in dict_abun.items():
-        base_quota[species] = total_bases * abun / total_abun - current_species_base_dict[species]
 
-    length_list_pointer = 0
+def choose_species(length_list, seg_list, quotas):
+    # Species of the segments of the reads, taken from quotas (species_quota) in order. The reads have seg_list
+    # segments, with the lengths in length_list, and the segments beyond length_list are left out
+    species_list = []
     pre_species = ''
-    num_reads = len(length_list_sorted)
-    for seg in seg_list_sorted:
-        if length_list_pointer + seg > num_reads:
+    for seg in seg_list:
+        if len(species_list) == len(length_list):
             break
         for each_seg in range(seg):
-            if each_seg == 0:
-                available_species = [s for s, q in base_quota.items()
-                                     if q - length_list_sorted[length_list_pointer] > 0]
-                if len(available_species) == 0:
-                    available_species = [s for s, q in base_quota.items() if q > 0]
-                species = random.choice(available_species)
-            else:
-                available_species = [s for s, q in base_quota.items()
-                                     if q - length_list_sorted[length_list_pointer] > 0 and s != pre_species]
+            # Species are drawn among those whose quota holds the segment, or else among those with a quota left.
+            # Succedent segments stay in the species of the previous one with the inflated abundance of that species
+            length = length_list[len(species_list)]
+            species = None
+            if each_seg > 0:
                 p = random.uniform(0, 100)
-                if p <= dict_abun_inflated[pre_species] and base_quota[pre_species] > 0:
+                if p <= dict_abun_inflated[pre_species] and quotas.remaining(pre_species) > 0:
                     species = pre_species
-                elif p > dict_abun_inflated[pre_species] and len(available_species) > 0:
-                    species = random.choice(available_species)
-                else:
-                    available_species = [s for s, q in base_quota.items()
-                                         if q - length_list_sorted[length_list_pointer] > 0]
-                    if len(available_species) == 0:
-                        available_species = [s for s, q in base_quota.items() if q > 0]
-                    species = random.choice(available_species)
-
-            species_list[length_list_pointer] = species
-            base_quota[species] -= length_list_sorted[length_list_pointer]
-            length_list_pointer += 1
+                elif p > dict_abun_inflated[pre_species]:
+                    species = quotas.choice(length, exclude=pre_species)
+            if species is None:
+                species = quotas.choice(length) or quotas.choice(0)
+
+            species_list.append(species)
+            quotas.take(species, length)
             pre_species = species
+    return species_list
+
+
+def assign_species(length_list, seg_list, current_species_base_dict, planned_bases=None):
+    # Species of the segments of the reads, returned with the lengths and numbers of segments in the order of
+    # order_segments. The base quota of each species is its share of all the bases, counting those already assigned in
+    # current_species_base_dict, or with planned_bases (the bases planned for each species in a batch of reads), the
+    # bases planned for it plus its share of the bases beyond (or short of) those planned
+    length_list_sorted, seg_list_sorted = order_segments(length_list, seg_list)
+
+    bases_to_add = sum(length_list)
+    current_bases = sum(current_species_base_dict.values())
+    total_bases = bases_to_add + current_bases
 
-    return species_list[:length_list_pointer], length_list_sorted[:length_list_pointer], \
-           np.array(seg_list_sorted[:length_list_pointer])
+    planned_bases = planned_bases or {}
+    extra_bases = total_bases - sum(planned_bases.values())
+    base_quota = {}
+    total_abun = sum(dict_abun.values())
+    for species, abun in dict_abun.items():
+        base_quota[species] = planned_bases.get(species, 0) + extra_bases * abun / total_abun - \
+            current_species_base_dict[species]
+
+    species_list = choose_species(length_list_sorted, seg_list_sorted, species_quota(base_quota))
+    return species_list, length_list_sorted, seg_list_sorted
+
+
+def draw_num_segments(num_simulate, chimeric):
+    # Number of segments of each of num_simulate aligned reads
+    if chimeric:
+        return np.random.geometric(1 / segment_mean, num_simulate)
+    return np.ones(num_simulate, dtype=int)
+
+
+def draw_ref_lengths(remaining_reads, remaining_segments, per, min_l, max_l, median_l, sd_l):
+    # Reference lengths of the segments of remaining_reads aligned reads of a metagenome, and unless per, the
+    # head and tail lengths and head ratios of the reads. Also returns the number of reference lengths drawn before
+    # dropping those out of range
+    remainder_lengths = None
+    head_vs_ht_ratio_list = None
+    if per:
+        ref_lengths = get_length_kde(kde_aligned, sum(remaining_segments)) if median_l is None else \
+            np.random.lognormal(np.log(median_l), sd_l, remaining_segments)
+        num_drawn = len(ref_lengths)
+        ref_lengths = [x for x in ref_lengths if min_l <= x <= max_l]
+    else:
+        remainder_lengths = get_length_kde(kde_ht, int(remaining_reads * 1.3), True)
+        remainder_lengths = [x for x in remainder_lengths if x >= 0]
+        head_vs_ht_ratio_list = get_length_kde(kde_ht_ratio, int(remaining_reads * 1.5))
+        head_vs_ht_ratio_list = [x for x in head_vs_ht_ratio_list if 0 <= x <= 1]
+        if median_l is None:
+            ref_lengths = get_length_kde(kde_aligned, sum(remaining_segments))
+        else:
+            total_lengths = np.random.lognormal(np.log(median_l + sd_l ** 2 / 2), sd_l, remaining_reads)
+            num_current_loop = min(remaining_reads, len(remainder_lengths), len(head_vs_ht_ratio_list))
+            ref_lengths = total_lengths[:num_current_loop] - remainder_lengths[:num_current_loop]
+        num_drawn = len(ref_lengths)
+        ref_lengths = [x for x in ref_lengths if 0 < x <= max_l]
+    return ref_lengths, remainder_lengths, head_vs_ht_ratio_list, num_drawn
+
+
+def plan_species(run_seed, stream, batches, sample_abun, per, min_l, max_l, median_l, sd_l, chimeric):
+    # Numbers of segments, lengths and species of the reads first simulated by each of batches ((batch number,
+    # first_index, num_simulate) of the aligned reads of a metagenome sample simulated from the seed streams of stream).
+    # The numbers of segments and lengths of each batch are drawn here once, from a stream of their own next to that of
+    # the batch, and the species are assigned to the reads of all the batches at once, as assign_species would for the
+    # whole sample: chimeric reads first, then the non-chimeric reads by decreasing length, so that the abundances do
+    # not depend on the batch size. Returns, for each batch, the numbers of segments, the output of draw_ref_lengths,
+    # the species of the segments in the order of order_segments, and the bases planned for each species
+    global dict_abun, dict_abun_inflated
+    dict_abun, dict_abun_inflated = sample_abun
+    batch_draws = []
+    batch_lengths = []
+    chimeric_lengths = []
+    chimeric_segs = []
+    chimeric_idx = []
+    single_lengths = []
+    single_idx = []
+    for batch_id, first_index, num_simulate in batches:
+        seed_batch(run_seed, stream + (batch_id, 1))
+        num_segment = draw_num_segments(num_simulate, chimeric)
+        drawn = draw_ref_lengths(num_simulate, num_segment, per, min_l, max_l, median_l, sd_l)
+        batch_draws.append((num_segment, drawn))
+        ref_lengths, num_segment = order_segments(drawn[0], num_segment)
+        segs_chimera = int(num_segment[num_segment > 1].sum())
+        chimeric_lengths.extend(ref_lengths[:segs_chimera])
+        chimeric_segs.extend(num_segment[num_segment > 1].tolist())
+        chimeric_idx.extend((len(batch_lengths), i) for i in xrange(segs_chimera))
+        single_lengths.extend(ref_lengths[segs_chimera:])
+        single_idx.extend((len(batch_lengths), i) for i in xrange(segs_chimera, len(ref_lengths)))
+        batch_lengths.append(ref_lengths)
+
+    order = np.argsort(-np.array(single_lengths, dtype=float), kind="stable")
+    length_list = chimeric_lengths + [single_lengths[i] for i in order]
+    seg_idx = chimeric_idx + [single_idx[i] for i in order]
+    total_bases = sum(length_list)
+    total_abun = sum(dict_abun.values())
+    quotas = species_quota({species: total_bases * abun / total_abun for species, abun in dict_abun.items()})
+    species_list = choose_species(length_list, chimeric_segs + [1] * len(single_lengths), quotas)
+
+    batch_species = [[None] * len(x) for x in batch_lengths]
+    for (batch, i), species in zip(seg_idx, species_list):
+        batch_species[batch][i] = species
+    plan = []
+    for (num_segment, drawn), species_list, ref_lengths in zip(batch_draws, batch_species, batch_lengths):
+        planned_bases = {}
+        for species, length in zip(species_list, ref_lengths):
+            planned_bases[species] = planned_bases.get(species, 0) + length
+        plan.append((num_segment, drawn, species_list, planned_bases))
+    return plan
 
 
 def simulation_aligned_metagenome(min_l, max_l, median_l, sd_l, out_reads, out_error, kmer_bias, basecaller,
-                                  read_type, fastq, num_simulate, per=False, chimeric=False):
-    # Simulate aligned reads
-    out_reads = open(out_reads, "w")
-    out_error = open(out_error, "w")
+                                  read_type, fastq, num_simulate, per=False, chimeric=False, first_index=0,
+                                  out_truth=None, plan=None):
+    # Simulate aligned reads. With plan (from plan_species), the reads are first simulated with the numbers of
+    # segments, lengths and species planned for them, and the reads drawn again get species fitting the bases planned
+    # for the batch
 
     id_begin = '@' if fastq else '>'
 
     remaining_reads = num_simulate
-    if chimeric:
-        num_segment = np.random.geometric(1 / segment_mean, num_simulate)
+    if plan:
+        num_segment, drawn, planned_species, planned_bases = plan
     else:
-        num_segment = np.ones(num_simulate, dtype=int)
+        num_segment = draw_num_segments(num_simulate, chimeric)
+        drawn, planned_species, planned_bases = None, None, None
     remaining_segments = num_segment
     remaining_gaps = remaining_segments - 1
     passed = 0
     current_species_bases = {species: 0 for species in dict_abun.keys()}
     while remaining_reads > 0:
-        if per:
-            ref_lengths = get_length_kde(kde_aligned, sum(remaining_segments)) if median_l is None else \
-                np.random.lognormal(np.log(median_l), sd_l, remaining_segments)
-            ref_lengths = [x for x in ref_lengths if min_l <= x <= max_l]
-        else:
-            remainder_lengths = get_length_kde(kde_ht, int(remaining_reads * 1.3), True)
-            remainder_lengths = [x for x in remainder_lengths if x >= 0]
-            head_vs_ht_ratio_list = get_length_kde(kde_ht_ratio, int(remaining_reads * 1.5))
-            head_vs_ht_ratio_list = [x for x in head_vs_ht_ratio_list if 0 <= x <= 1]
-            if median_l is None:
-                ref_lengths = get_length_kde(kde_aligned, sum(remaining_segments))
-            else:
-                total_lengths = np.random.lognormal(np.log(median_l + sd_l ** 2 / 2), sd_l, remaining_reads)
-                num_current_loop = min(remaining_reads, len(remainder_lengths), len(head_vs_ht_ratio_list))
-                ref_lengths = total_lengths[:num_current_loop] - remainder_lengths[:num_current_loop]
-            ref_lengths = [x for x in ref_lengths if 0 < x <= max_l]
+        ref_lengths, remainder_lengths, head_vs_ht_ratio_list, num_drawn = \
+            drawn or draw_ref_lengths(remaining_reads, remaining_segments, per, min_l, max_l, median_l, sd_l)
+        drawn = None
+        pf.stats.count("rejected_lengths", num_drawn - len(ref_lengths))
 
         gap_lengths = get_length_kde(kde_gap, sum(remaining_gaps), True) if sum(remaining_gaps) > 0 else []
         gap_lengths = [max(0, int(x)) for x in gap_lengths]
 
         # Select strain/species to simulate
-        species_pool, ref_lengths, remaining_segments = \
-            assign_species(ref_lengths, remaining_segments, current_species_bases)
+        if planned_species is not None:
+            species_pool = planned_species
+            ref_lengths, remaining_segments = order_segments(ref_lengths, remaining_segments)
+            planned_species = None
+        else:
+            species_pool, ref_lengths, remaining_segments = \
+                assign_species(ref_lengths, remaining_segments, current_species_bases, planned_bases)
+
+        if not per:
+            error_batch = error_list_batch([int(round(x)) for x in ref_lengths], match_markov_model, match_ht_list,
+                                           error_par, trans_error_pr, fastq)
+        redraw = False
 
         seg_pointer = 0
         gap_pointer = 0
@@ -820,16 +988,17 @@ def simulation_aligned_metagenome(min_l, max_l, median_l, sd_l, out_reads, out_e
                 seg_pointer += 1
                 gap_pointer += 1
                 species_pointer += 1
-                with total_simulated.get_lock():
-                    sequence_index = total_simulated.value
-                    total_simulated.value += 1
+                sequence_index = first_index + passed
 
                 # Extract middle region from reference genome
                 new_read = ""
                 new_read_name = ""
                 base_quals = []
+                truth_segments = []
                 for seg_idx in range(len(ref_length_list)):
-                    new_seg, new_seg_name = extract_read("metagenome", ref_length_list[seg_idx], species_list[seg_idx])
+                    new_seg, new_seg_name, blocks = extract_read("metagenome", ref_length_list[seg_idx],
+                                                                 species_list[seg_idx])
+                    truth_segments.append((len(new_read), new_seg, np.arange(len(new_seg)), new_seg, blocks))
                     new_read += new_seg
                     new_read_name += new_seg_name
                     if fastq:
@@ -837,7 +1006,7 @@ def simulation_aligned_metagenome(min_l, max_l, median_l, sd_l, out_reads, out_e
                                                                ref_length_list[seg_idx]).tolist())
 
                 new_read_name = new_read_name + "_perfect_" + str(sequence_index)
-                read_mutated = case_convert(new_read)  # not mutated actually, just to be consistent with per == False
+                read_mutated = new_read  # already uppercase with IUPAC codes resolved by the reference
 
                 head = 0
                 tail = 0
@@ -846,8 +1015,7 @@ def simulation_aligned_metagenome(min_l, max_l, median_l, sd_l, out_reads, out_e
                 gap_list = []
                 gap_base_qual_list = []
                 seg_length_list = []
-                seg_error_dict_list = []
-                seg_error_count_list = []
+                seg_error_list = []
                 remainder = int(round(remainder_lengths[each_read]))
                 head_vs_ht_ratio = head_vs_ht_ratio_list[each_read]
 
@@ -857,24 +1025,29 @@ def simulation_aligned_metagenome(min_l, max_l, median_l, sd_l, out_reads, out_e
                     gap_list.append(mutated_gap)
                     gap_base_qual_list.append(gap_base_quals)
                     total += len(mutated_gap)
-                for each_ref in ref_length_list:
-                    middle, middle_ref, error_dict, error_count = \
-                        error_list(each_ref, match_markov_model, match_ht_list, error_par, trans_error_pr, fastq)
+                for x in range(segments):
+                    # A rejected read is retried with the same reference lengths, but new errors
+                    if redraw:
+                        middle, middle_ref, error_events, error_count = \
+                            error_list(ref_length_list[x], match_markov_model, match_ht_list, error_par,
+                                       trans_error_pr, fastq)
+                    else:
+                        middle, middle_ref, error_events, error_count = error_batch_item(error_batch, seg_pointer + x)
                     total += middle
                     seg_length_list.append(middle_ref)
-                    seg_error_dict_list.append(error_dict)
-                    seg_error_count_list.append(error_count)
+                    seg_error_list.append(error_events)
 
                 if total < min_l or total > max_l:
+                    redraw = True
                     continue
 
+                redraw = False
+
                 seg_pointer += segments
                 gap_pointer += segments - 1
                 species_pointer += segments
 
-                with total_simulated.get_lock():
-                    sequence_index = total_simulated.value
-                    total_simulated.value += 1
+                sequence_index = first_index + passed
 
                 if remainder == 0:
                     head = 0
@@ -887,17 +1060,19 @@ def simulation_aligned_metagenome(min_l, max_l, median_l, sd_l, out_reads, out_e
                 read_mutated = ""
                 new_read_name = ""
                 base_quals = []
+                truth_segments = []
                 for seg_idx in range(len(seg_length_list)):
-                    new_seg, new_seg_name = extract_read("metagenome", seg_length_list[seg_idx], species_list[seg_idx])
+                    new_seg, new_seg_name, blocks = extract_read("metagenome", seg_length_list[seg_idx],
+                                                                 species_list[seg_idx])
                     # Mutate read
-                    new_seg = case_convert(new_seg)
-                    seg_mutated, seg_base_quals = \
-                        mutate_read(new_seg, new_seg_name, out_error, seg_error_dict_list[seg_idx],
-                                    seg_error_count_list[seg_idx], basecaller, read_type, fastq, kmer_bias)
+                    seg_mutated, seg_base_quals, ref_map = \
+                        mutate_read(new_seg, new_seg_name, out_error, seg_error_list[seg_idx], basecaller, read_type,
+                                    fastq, kmer_bias)
 
                     if kmer_bias:
-                        seg_mutated, seg_base_quals = mutate_homo(seg_mutated, seg_base_quals, kmer_bias, basecaller,
-                                                                  None)
+                        seg_mutated, seg_base_quals, ref_map = \
+                            mutate_homo(seg_mutated, seg_base_quals, kmer_bias, basecaller, None, ref_map)
+                    truth_segments.append((len(read_mutated), seg_mutated, ref_map, new_seg, blocks))
                     new_read_name += new_seg_name + ';'
                     read_mutated += seg_mutated
                     base_quals.extend(seg_base_quals)
@@ -917,35 +1092,32 @@ def simulation_aligned_metagenome(min_l, max_l, median_l, sd_l, out_reads, out_e
                     base_quals = ht_quals[:head] + base_quals + ht_quals[head:]
 
             # Add head and tail region
-            read_mutated = ''.join(np.random.choice(BASES, head)) + read_mutated + \
-                           ''.join(np.random.choice(BASES, tail))
+            head_seq, tail_seq = sq.random_bases_batch((head, tail))
+            read_mutated = head_seq + read_mutated + tail_seq
 
             # Reverse complement half of the reads
-            p = random.random()
-            if p > strandness_rate:
-                read_mutated = reverse_complement(read_mutated)
+            reverse = random.random() > strandness_rate
+            read_mutated = sq.orient(read_mutated, reverse)
+            if reverse:
                 new_read_name += "_R"
                 base_quals.reverse()
             else:
                 new_read_name += "_F"
 
+            # Each read is written at once, so that records from different processes are never interleaved
             if per:
-                out_reads.write(id_begin + new_read_name + "_0_" + str(sum(ref_length_list)) + "_0" + '\n')
+                read_id = new_read_name + "_0_" + str(sum(ref_length_list)) + "_0"
             else:
-                out_reads.write(id_begin + new_read_name + "_" + str(head) + "_" +
-                                ";".join(str(x) for x in ref_length_list) + "_" + str(tail) + '\n')
-            out_reads.write(read_mutated + '\n')
+                read_id = new_read_name + "_" + str(head) + "_" + ";".join(str(x) for x in ref_length_list) + "_" + \
+                          str(tail)
+            read_record = id_begin + read_id + '\n' + read_mutated + '\n'
 
             if fastq:
-                out_reads.write("+\n")
-                out_quals = "".join([chr(qual + 33) for qual in base_quals])
-                out_reads.write(out_quals + "\n")
-
-            if (sequence_index + 1) % 100 == 0:
-                sys.stdout.write(strftime("%Y-%m-%d %H:%M:%S") + ": Number of reads simulated >> " +
-                                 str(sequence_index + 1) + "\r")
-                # +1 is just to ignore the zero index by python
-                sys.stdout.flush()
+                read_record += "+\n" + mm.phred_string(base_quals) + "\n"
+            out_reads.write(read_record)
+            pf.stats.add_read(len(read_mutated))
+            if out_truth is not None:
+                out_truth.write(tr.paf_records(read_id, len(read_mutated), head, reverse, truth_segments))
 
             passed += 1
 
@@ -953,16 +1125,13 @@ def simulation_aligned_metagenome(min_l, max_l, median_l, sd_l, out_reads, out_e
         remaining_segments = num_segment[passed:]
         remaining_gaps = remaining_segments - 1
 
-    sys.stdout.write('\n')
     out_reads.close()
-    out_error.close()
 
 
 def simulation_aligned_transcriptome(model_ir, out_reads, out_error, kmer_bias, basecaller, read_type, num_simulate,
-                                     polya, fastq, per=False, uracil=False):
+                                     polya, fastq, per=False, uracil=False, first_index=0,
+                                     out_truth=None):
     # Simulate aligned reads
-    out_reads = open(out_reads, "w")
-    out_error = open(out_error, "w")
 
     if fastq:
         id_begin = "@"
@@ -976,182 +1145,184 @@ def simulation_aligned_transcriptome(model_ir, out_reads, out_error, kmer_bias,
             if "chr" in item:
                 flag_chrom = True
                 break
-    sampled_2d_lengths = get_length_kde(kde_aligned_2d, num_simulate, False, False)
+    kde2d_index = index_kde2d(get_length_kde(kde_aligned_2d, max(num_simulate, KDE_2D_SAMPLES), False, False))
 
     remainder_l = get_length_kde(kde_ht, num_simulate, True)
     head_vs_ht_ratio_temp = get_length_kde(kde_ht_ratio, num_simulate)
     head_vs_ht_ratio_l = [1 if x > 1 else x for x in head_vs_ht_ratio_temp]
     head_vs_ht_ratio_l = [0 if x < 0 else x for x in head_vs_ht_ratio_l]
 
+    trx_ids = ecdf_dict_ref_exp[1]
+    trx_lengths = ecdf_dict_ref_exp[2]
+
     remaining_reads = 0
     while remaining_reads < num_simulate:
-        while True:
-            ref_trx, ref_trx_len = select_ref_transcript(ecdf_dict_ref_exp)
+        # Select reference transcripts and aligned lengths for all remaining reads, then simulate their errors at once.
+        # Pairs where the aligned length does not fit in the transcript are drawn again
+        trx_batch = []
+        while len(trx_batch) < num_simulate - remaining_reads:
+            num_drawn = num_simulate - remaining_reads - len(trx_batch)
+            trx_idx = select_ref_transcript(ecdf_dict_ref_exp, num_drawn)
+            if model_ir:
+                trx_idx = trx_idx[trx_in_structure[trx_idx]]
+            trx_len = trx_lengths[trx_idx]
+            len_aligned = select_nearest_kde2d(kde2d_index, trx_len)
+            fit = len_aligned < trx_len
+            trx_batch.extend(zip([trx_ids[i] for i in trx_idx[fit]], trx_len[fit].tolist(), len_aligned[fit].tolist()))
+            pf.stats.count("transcript_retries", num_drawn - np.count_nonzero(fit))
+
+        if not per:
+            error_batch = error_list_batch([x[2] for x in trx_batch], match_markov_model, match_ht_list, error_par,
+                                           trans_error_pr, fastq)
+
+        for each_read in xrange(len(trx_batch)):
+            ref_trx, ref_trx_len, ref_len_aligned = trx_batch[each_read]
             if polya and ref_trx in trx_with_polya:
                 trx_has_polya = True
             else:
                 trx_has_polya = False
 
-            if model_ir:
-                if ref_trx in dict_ref_structure:
-                    ref_trx_len_fromstructure = ref_len_from_structure(dict_ref_structure[ref_trx])
-                    if ref_trx_len == ref_trx_len_fromstructure:
-                        ref_len_aligned = select_nearest_kde2d(sampled_2d_lengths, ref_trx_len)
-                        if ref_len_aligned < ref_trx_len:
-                            break
-            else:
-                ref_len_aligned = select_nearest_kde2d(sampled_2d_lengths, ref_trx_len)
-                if ref_len_aligned < ref_trx_len:
-                    break
-        if per:
-            with total_simulated.get_lock():
-                sequence_index = total_simulated.value
-                total_simulated.value += 1
+            if per:
+                sequence_index = first_index + remaining_reads
 
-            new_read, ref_start_pos, retain_polya = extract_read_trx(ref_trx, ref_len_aligned, trx_has_polya)
-            new_read_name = ref_trx + "_" + str(ref_start_pos) + "_perfect_" + str(sequence_index)
-            read_mutated = case_convert(new_read)  # not mutated actually, just to be consistent with per == False
+                new_read, ref_start_pos, retain_polya = extract_read_trx(ref_trx, ref_len_aligned, trx_has_polya)
+                new_read_name = ref_trx + "_" + str(ref_start_pos) + "_perfect_" + str(sequence_index)
+                read_mutated = new_read  # already uppercase with IUPAC codes resolved by the reference
+                truth_segments = [(0, new_read, np.arange(len(new_read)), new_read,
+                                   [(ref_names[ref_trx], ref_trx_len, ref_start_pos, ref_len_aligned, False)])]
 
-            if fastq:
-                base_quals = mm.trunc_lognorm_rvs("match", read_type, basecaller, ref_len_aligned).tolist()
-            else:
-                base_quals = []
-
-            head = 0
-            tail = 0
+                if fastq:
+                    base_quals = mm.trunc_lognorm_rvs("match", read_type, basecaller, ref_len_aligned).tolist()
+                else:
+                    base_quals = []
 
-        else:
-            middle_read, middle_ref, error_dict, error_count = error_list(ref_len_aligned, match_markov_model,
-                                                                          match_ht_list, error_par, trans_error_pr,
-                                                                          fastq)
+                head = 0
+                tail = 0
 
-            if middle_ref > ref_trx_len:
-                continue
+            else:
+                middle_read, middle_ref, error_events, error_count = error_batch_item(error_batch, each_read)
 
-            with total_simulated.get_lock():
-                sequence_index = total_simulated.value
-                total_simulated.value += 1
+                if middle_ref > ref_trx_len:
+                    pf.stats.count("transcript_retries")
+                    continue
 
-            ir_list = []
-            if model_ir:
-                ir_flag, ref_trx_structure_new = update_structure(dict_ref_structure[ref_trx], IR_markov_model)
-                if ir_flag:
-                    list_iv, retain_polya, ir_list = extract_read_pos(middle_ref, ref_trx_len, ref_trx_structure_new,
-                                                                      trx_has_polya)
-                    new_read = ""
-                    flag = False
-                    for interval in list_iv:
-                        chrom = interval.chrom
-                        if flag_chrom:
-                            chrom = "chr" + chrom
-                        if chrom not in genome_fai.references:
-                            flag = True
-                            break
-                        start = interval.start
-                        end = interval.end
-                        new_read += genome_fai.fetch(chrom, start, end)  # len(new_read) > middle_ref
-                    if flag:
-                        continue
-                    ref_start_pos = list_iv[0].start
+                sequence_index = first_index + remaining_reads
+
+                ir_list = []
+                if model_ir:
+                    ir_flag, ref_trx_structure_new = update_structure(dict_ref_structure[ref_trx], IR_markov_model)
+                    if ir_flag:
+                        list_iv, retain_polya, ir_list = extract_read_pos(middle_ref, ref_trx_len,
+                                                                          ref_trx_structure_new, trx_has_polya)
+                        new_read = ""
+                        blocks = []
+                        flag = False
+                        for interval in list_iv:
+                            chrom = interval.chrom
+                            if flag_chrom:
+                                chrom = "chr" + chrom
+                            if chrom not in genome_fai.references:
+                                flag = True
+                                break
+                            start = interval.start
+                            end = interval.end
+                            # len(new_read) > middle_ref
+                            new_read += case_convert(genome_fai.fetch(chrom, start, end))
+                            blocks.append((chrom, genome_fai.get_reference_length(chrom), start, end - start, False))
+                        if flag:
+                            pf.stats.count("transcript_retries")
+                            continue
+                        ref_start_pos = list_iv[0].start
  
-                    if interval.strand == '-':  # Keep the read direction the same as reference transcripts
-                        new_read = reverse_complement(new_read)
+                        if interval.strand == '-':  # Keep the read direction the same as reference transcripts
+                            new_read = sq.reverse_complement(new_read)
+                            blocks = [x[:4] + (True,) for x in reversed(blocks)]
+                    else:
+                        new_read, ref_start_pos, retain_polya = extract_read_trx(ref_trx, middle_ref, trx_has_polya)
+                        blocks = [(ref_names[ref_trx], ref_trx_len, ref_start_pos, middle_ref, False)]
 
-                    if fastq:  # since len(new_read) > middle_ref if IR, add more match quals for retained intron
-                        error_count["match"] += len(new_read) - middle_ref
                 else:
                     new_read, ref_start_pos, retain_polya = extract_read_trx(ref_trx, middle_ref, trx_has_polya)
+                    blocks = [(ref_names[ref_trx], ref_trx_len, ref_start_pos, middle_ref, False)]
 
-            else:
-                new_read, ref_start_pos, retain_polya = extract_read_trx(ref_trx, middle_ref, trx_has_polya)
+                new_read_name = str(ref_trx) + "_" + str(ref_start_pos) + "_aligned_" + str(sequence_index)
+                if len(ir_list) > 0:
+                    new_read_name += "_RetainedIntron_"
+                    for ir_tuple in ir_list:
+                        new_read_name += '-'.join(str(x) for x in ir_tuple) + ';'
 
-            new_read_name = str(ref_trx) + "_" + str(ref_start_pos) + "_aligned_" + str(sequence_index)
-            if len(ir_list) > 0:
-                new_read_name += "_RetainedIntron_"
-                for ir_tuple in ir_list:
-                    new_read_name += '-'.join(str(x) for x in ir_tuple) + ';'
+                # start HD len simulation
+                remainder = int(remainder_l[remaining_reads])
+                head_vs_ht_ratio = head_vs_ht_ratio_l[remaining_reads]
 
-            # start HD len simulation
-            remainder = int(remainder_l[remaining_reads])
-            head_vs_ht_ratio = head_vs_ht_ratio_l[remaining_reads]
-
-            if remainder == 0:
-                head = 0
-                tail = 0
+                if remainder == 0:
+                    head = 0
+                    tail = 0
+                else:
+                    head = int(round(remainder * head_vs_ht_ratio))
+                    tail = remainder - head
+                # end HD len simulation
+
+                # Mutate read
+                read_mutated, base_quals, ref_map = mutate_read(new_read, new_read_name, out_error, error_events,
+                                                                basecaller, read_type, fastq, kmer_bias)
+                if kmer_bias:
+                    read_mutated, base_quals, ref_map = mutate_homo(read_mutated, base_quals, kmer_bias, basecaller,
+                                                                    read_type, ref_map)
+                truth_segments = [(0, read_mutated, ref_map, new_read, blocks)]
+
+            if retain_polya:
+                if basecaller == "albacore":
+                    polya_len = int(scipy.stats.expon.rvs(loc=2.0, scale=2.409858743694814))
+                else:  # guppy
+                    polya_len = int(scipy.stats.expon.rvs(loc=2.0, scale=4.168299657168961))
+                read_mutated += "A" * polya_len
             else:
-                head = int(round(remainder * head_vs_ht_ratio))
-                tail = remainder - head
-            # end HD len simulation
-
-            # Mutate read
-            new_read = case_convert(new_read)
-            read_mutated, base_quals = mutate_read(new_read, new_read_name, out_error, error_dict, error_count,
-                                                   basecaller, read_type, fastq, kmer_bias)
-            if kmer_bias:
-                read_mutated, base_quals = mutate_homo(read_mutated, base_quals, kmer_bias, basecaller, read_type)
-
-        if retain_polya:
-            if basecaller == "albacore":
-                polya_len = int(scipy.stats.expon.rvs(loc=2.0, scale=2.409858743694814))
-            else:  # guppy
-                polya_len = int(scipy.stats.expon.rvs(loc=2.0, scale=4.168299657168961))
-            read_mutated += "A" * polya_len
-        else:
-            polya_len = 0
+                polya_len = 0
 
-        if fastq:  # Get head/tail qualities
-            ht_quals = mm.trunc_lognorm_rvs("ht", read_type, basecaller, head + tail + polya_len).tolist()
-            for a in xrange(polya_len):
-                base_quals.append(ht_quals.pop())
-            base_quals = ht_quals[:head] + base_quals + ht_quals[head:]
+            if fastq:  # Get head/tail qualities
+                ht_quals = mm.trunc_lognorm_rvs("ht", read_type, basecaller, head + tail + polya_len).tolist()
+                for a in xrange(polya_len):
+                    base_quals.append(ht_quals.pop())
+                base_quals = ht_quals[:head] + base_quals + ht_quals[head:]
 
-        # Add head and tail region
-        read_mutated = ''.join(np.random.choice(BASES, head)) + read_mutated + ''.join(np.random.choice(BASES, tail))
+            # Add head and tail region
+            head_seq, tail_seq = sq.random_bases_batch((head, tail))
+            read_mutated = head_seq + read_mutated + tail_seq
         
-        # Reverse complement according to strandness rate
-        p = random.random()
-        if p > strandness_rate:
-            read_mutated = reverse_complement(read_mutated)
-            new_read_name += "_R"
-            base_quals.reverse()
-        else:
-            new_read_name += "_F"
-
-        if per:
-            out_reads.write(id_begin + new_read_name + "_0_" + str(ref_len_aligned + polya_len) + "_0" + '\n')
-        else:
-            out_reads.write(id_begin + new_read_name + "_" + str(head) + "_" + str(middle_ref) + "_" +
-                            str(tail + polya_len) + '\n')
+            # Reverse complement according to strandness rate, and turn T into U if uracil
+            reverse = random.random() > strandness_rate
+            read_mutated = sq.orient(read_mutated, reverse, uracil)
+            if reverse:
+                new_read_name += "_R"
+                base_quals.reverse()
+            else:
+                new_read_name += "_F"
 
-        if uracil:
-            read_mutated = read_mutated.translate(trantab)
+            # Each read is written at once, so that records from different processes are never interleaved
+            if per:
+                read_id = new_read_name + "_0_" + str(ref_len_aligned + polya_len) + "_0"
+            else:
+                read_id = new_read_name + "_" + str(head) + "_" + str(middle_ref) + "_" + str(tail + polya_len)
 
-        out_reads.write(read_mutated + '\n')
+            read_record = id_begin + read_id + '\n' + read_mutated + '\n'
 
-        if fastq:
-            out_reads.write("+\n")
-            out_quals = "".join([chr(qual + 33) for qual in base_quals])
-            out_reads.write(out_quals + "\n")
-
-        if (sequence_index + 1) % 100 == 0:
-            sys.stdout.write(strftime("%Y-%m-%d %H:%M:%S") + ": Number of reads simulated >> " +
-                             str(sequence_index + 1) + "\r")
-            # +1 is just to ignore the zero index by python
-            sys.stdout.flush()
+            if fastq:
+                read_record += "+\n" + mm.phred_string(base_quals) + "\n"
+            out_reads.write(read_record)
+            pf.stats.add_read(len(read_mutated))
+            if out_truth is not None:
+                out_truth.write(tr.paf_records(read_id, len(read_mutated), head, reverse, truth_segments))
 
-        remaining_reads += 1
+            remaining_reads += 1
 
-    sys.stdout.write('\n')
     out_reads.close()
-    out_error.close()
 
 
 def simulation_aligned_genome(dna_type, min_l, max_l, median_l, sd_l, out_reads, out_error, kmer_bias, basecaller,
-                              read_type, fastq, num_simulate, per=False, chimeric=False):
+                              read_type, fastq, num_simulate, per=False, chimeric=False, first_index=0, out_truth=None):
 
     # Simulate aligned reads
-    out_reads = open(out_reads, "w")
-    out_error = open(out_error, "w")
 
     id_begin = '@' if fastq else '>'
 
@@ -1167,7 +1338,9 @@ def simulation_aligned_genome(dna_type, min_l, max_l, median_l, sd_l, out_reads,
         if per:
             ref_lengths = get_length_kde(kde_aligned, sum(remaining_segments)) if median_l is None else \
                 np.random.lognormal(np.log(median_l), sd_l, remaining_segments)
+            num_drawn = len(ref_lengths)
             ref_lengths = [x for x in ref_lengths if min_l <= x <= max_l]
+            pf.stats.count("rejected_lengths", num_drawn - len(ref_lengths))
         else:
             remainder_lengths = get_length_kde(kde_ht, int(remaining_reads * 1.3), True)
             remainder_lengths = [x for x in remainder_lengths if x >= 0]
@@ -1179,11 +1352,18 @@ def simulation_aligned_genome(dna_type, min_l, max_l, median_l, sd_l, out_reads,
                 total_lengths = np.random.lognormal(np.log(median_l + sd_l ** 2 / 2), sd_l, remaining_reads)
                 num_current_loop = min(remaining_reads, len(remainder_lengths), len(head_vs_ht_ratio_list))
                 ref_lengths = total_lengths[:num_current_loop] - remainder_lengths[:num_current_loop]
+            num_drawn = len(ref_lengths)
             ref_lengths = [x for x in ref_lengths if 0 < x <= max_l]
+            pf.stats.count("rejected_lengths", num_drawn - len(ref_lengths))
 
         gap_lengths = get_length_kde(kde_gap, sum(remaining_gaps), True) if sum(remaining_gaps) > 0 else []
         gap_lengths = [max(0, int(x)) for x in gap_lengths]
 
+        if not per:
+            error_batch = error_list_batch([int(x) for x in ref_lengths], match_markov_model, match_ht_list,
+                                           error_par, trans_error_pr, fastq)
+        redraw = False
+
         seg_pointer = 0
         gap_pointer = 0
         for each_read in xrange(remaining_reads):
@@ -1198,23 +1378,23 @@ def simulation_aligned_genome(dna_type, min_l, max_l, median_l, sd_l, out_reads,
             if per:
                 seg_pointer += 1
                 gap_pointer += 1
-                with total_simulated.get_lock():
-                    sequence_index = total_simulated.value
-                    total_simulated.value += 1
+                sequence_index = first_index + passed
 
                 # Extract middle region from reference genome
                 new_read = ""
                 new_read_name = ""
                 base_quals = []
+                truth_segments = []
                 for each_ref in ref_length_list:
-                    new_seg, new_seg_name = extract_read(dna_type, each_ref)
+                    new_seg, new_seg_name, blocks = extract_read(dna_type, each_ref)
+                    truth_segments.append((len(new_read), new_seg, np.arange(len(new_seg)), new_seg, blocks))
                     new_read += new_seg
                     new_read_name += new_seg_name
                     if fastq:
                         base_quals.extend(mm.trunc_lognorm_rvs("match", read_type, basecaller, each_ref).tolist())
 
                 new_read_name = new_read_name + "_perfect_" + str(sequence_index)
-                read_mutated = case_convert(new_read)  # not mutated actually, just to be consistent with per == False
+                read_mutated = new_read  # already uppercase with IUPAC codes resolved by the reference
 
                 head = 0
                 tail = 0
@@ -1223,8 +1403,7 @@ def simulation_aligned_genome(dna_type, min_l, max_l, median_l, sd_l, out_reads,
                 gap_list = []
                 gap_base_qual_list = []
                 seg_length_list = []
-                seg_error_dict_list = []
-                seg_error_count_list = []
+                seg_error_list = []
                 remainder = int(remainder_lengths[each_read])
                 head_vs_ht_ratio = head_vs_ht_ratio_list[each_read]
 
@@ -1233,23 +1412,28 @@ def simulation_aligned_genome(dna_type, min_l, max_l, median_l, sd_l, out_reads,
                     mutated_gap, gap_base_quals = simulation_gap(each_gap, basecaller, read_type, dna_type, fastq)
                     gap_list.append(mutated_gap)
                     gap_base_qual_list.append(gap_base_quals)
-                for each_ref in ref_length_list:
-                    middle, middle_ref, error_dict, error_count = \
-                        error_list(each_ref, match_markov_model, match_ht_list, error_par, trans_error_pr, fastq)
+                for x in range(segments):
+                    # A rejected read is retried with the same reference lengths, but new errors
+                    if redraw:
+                        middle, middle_ref, error_events, error_count = \
+                            error_list(ref_length_list[x], match_markov_model, match_ht_list, error_par,
+                                       trans_error_pr, fastq)
+                    else:
+                        middle, middle_ref, error_events, error_count = error_batch_item(error_batch, seg_pointer + x)
                     total += middle
                     seg_length_list.append(middle_ref)
-                    seg_error_dict_list.append(error_dict)
-                    seg_error_count_list.append(error_count)
+                    seg_error_list.append(error_events)
 
                 if total < min_l or total > max_l or max(seg_length_list) > max_chrom:
+                    redraw = True
                     continue
 
+                redraw = False
+
                 seg_pointer += segments
                 gap_pointer += segments - 1
 
-                with total_simulated.get_lock():
-                    sequence_index = total_simulated.value
-                    total_simulated.value += 1
+                sequence_index = first_index + passed
 
                 if remainder == 0:
                     head = 0
@@ -1262,17 +1446,18 @@ def simulation_aligned_genome(dna_type, min_l, max_l, median_l, sd_l, out_reads,
                 read_mutated = ""
                 new_read_name = ""
                 base_quals = []
+                truth_segments = []
                 for seg_idx in range(len(seg_length_list)):
-                    new_seg, new_seg_name = extract_read(dna_type, seg_length_list[seg_idx])
+                    new_seg, new_seg_name, blocks = extract_read(dna_type, seg_length_list[seg_idx])
                     # Mutate read
-                    new_seg = case_convert(new_seg)
-                    seg_mutated, seg_base_quals = \
-                        mutate_read(new_seg, new_seg_name, out_error, seg_error_dict_list[seg_idx],
-                                    seg_error_count_list[seg_idx], basecaller, read_type, fastq, kmer_bias)
+                    seg_mutated, seg_base_quals, ref_map = \
+                        mutate_read(new_seg, new_seg_name, out_error, seg_error_list[seg_idx], basecaller, read_type,
+                                    fastq, kmer_bias)
 
                     if kmer_bias:
-                        seg_mutated, seg_base_quals = mutate_homo(seg_mutated, seg_base_quals, kmer_bias, basecaller,
-                                                                  None)
+                        seg_mutated, seg_base_quals, ref_map = \
+                            mutate_homo(seg_mutated, seg_base_quals, kmer_bias, basecaller, None, ref_map)
+                    truth_segments.append((len(read_mutated), seg_mutated, ref_map, new_seg, blocks))
                     new_read_name += new_seg_name + ';'
                     read_mutated += seg_mutated
                     base_quals.extend(seg_base_quals)
@@ -1287,35 +1472,32 @@ def simulation_aligned_genome(dna_type, min_l, max_l, median_l, sd_l, out_reads,
                     base_quals = ht_quals[:head] + base_quals + ht_quals[head:]
 
             # Add head and tail region
-            read_mutated = ''.join(np.random.choice(BASES, head)) + read_mutated + \
-                           ''.join(np.random.choice(BASES, tail))
+            head_seq, tail_seq = sq.random_bases_batch((head, tail))
+            read_mutated = head_seq + read_mutated + tail_seq
 
             # Reverse complement half of the reads
-            p = random.random()
-            if p > strandness_rate:
-                read_mutated = reverse_complement(read_mutated)
+            reverse = random.random() > strandness_rate
+            read_mutated = sq.orient(read_mutated, reverse)
+            if reverse:
                 new_read_name += "_R"
                 base_quals.reverse()
             else:
                 new_read_name += "_F"
 
+            # Each read is written at once, so that records from different processes are never interleaved
             if per:
-                out_reads.write(id_begin + new_read_name + "_0_" + str(sum(ref_length_list)) + "_0" + '\n')
+                read_id = new_read_name + "_0_" + str(sum(ref_length_list)) + "_0"
             else:
-                out_reads.write(id_begin + new_read_name + "_" + str(head) + "_" +
-                                ";".join(str(x) for x in ref_length_list) + "_" + str(tail) + '\n')
-            out_reads.write(read_mutated + '\n')
+                read_id = new_read_name + "_" + str(head) + "_" + ";".join(str(x) for x in ref_length_list) + "_" + \
+                          str(tail)
+            read_record = id_begin + read_id + '\n' + read_mutated + '\n'
 
             if fastq:
-                out_reads.write("+\n")
-                out_quals = "".join([chr(qual + 33) for qual in base_quals])
-                out_reads.write(out_quals + "\n")
-
-            if (sequence_index + 1) % 100 == 0:
-                sys.stdout.write(strftime("%Y-%m-%d %H:%M:%S") + ": Number of reads simulated >> " +
-                                 str(sequence_index + 1) + "\r")
-                # +1 is just to ignore the zero index by python
-                sys.stdout.flush()
+                read_record += "+\n" + mm.phred_string(base_quals) + "\n"
+            out_reads.write(read_record)
+            pf.stats.add_read(len(read_mutated))
+            if out_truth is not None:
+                out_truth.write(tr.paf_records(read_id, len(read_mutated), head, reverse, truth_segments))
 
             passed += 1
 
@@ -1324,12 +1506,10 @@ def simulation_aligned_genome(dna_type, min_l, max_l, median_l, sd_l, out_reads,
         remaining_gaps = remaining_segments - 1
 
     out_reads.close()
-    out_error.close()
 
 
 def simulation_unaligned(dna_type, min_l, max_l, median_l, sd_l, out_reads, basecaller, read_type, fastq,
-                         num_simulate, uracil):
-    out_reads = open(out_reads, "w")
+                         num_simulate, uracil, first_index=0):
 
     if fastq:
         id_begin = "@"
@@ -1347,52 +1527,38 @@ def simulation_unaligned(dna_type, min_l, max_l, median_l, sd_l, out_reads, base
             # check if the total length fits the criteria
             ref = int(ref_l[j])
 
-            unaligned, middle_ref, error_dict, error_count = unaligned_error_list(ref, error_par)
+            unaligned, middle_ref, error_events, error_count = unaligned_error_list(ref, error_samplers)
 
             if unaligned < min_l or unaligned > max_l:
+                pf.stats.count("rejected_lengths")
                 continue
 
-            with total_simulated.get_lock():
-                sequence_index = total_simulated.value
-                total_simulated.value += 1
+            sequence_index = first_index + passed
 
-            new_read, new_read_name = extract_read(dna_type, middle_ref)
+            new_read, new_read_name, _ = extract_read(dna_type, middle_ref)
             new_read_name = new_read_name + "_unaligned_" + str(sequence_index)
-            # Change lowercase to uppercase and replace N with any base
-            new_read = case_convert(new_read)
             # no quals returned here since unaligned quals are not based on mis/ins/match qual distributions
-            read_mutated, _ = mutate_read(new_read, new_read_name, None, error_dict, error_count, basecaller,
-                                          read_type, False, False)
-
-            if fastq:
-                base_quals = mm.trunc_lognorm_rvs("unaligned", read_type, basecaller, len(read_mutated)).tolist()
-            else:
-                base_quals = []
+            read_mutated, _, _ = mutate_read(new_read, new_read_name, None, error_events, basecaller, read_type, False,
+                                             False)
 
-            # Reverse complement some of the reads based on direction information
-            p = random.random()
-            if p > strandness_rate:
-                read_mutated = reverse_complement(read_mutated)
+            # Reverse complement some of the reads based on direction information, and turn T into U if uracil
+            reverse = random.random() > strandness_rate
+            read_mutated = sq.orient(read_mutated, reverse, uracil)
+            if reverse:
                 new_read_name += "_R"
-                base_quals.reverse()
             else:
                 new_read_name += "_F"
 
-            out_reads.write(id_begin + new_read_name + "_0_" + str(middle_ref) + "_0" + '\n')
-            if uracil:
-                read_mutated = read_mutated.traslate(trantab)
-            out_reads.write(read_mutated + "\n")
+            # Each read is written at once, so that records from different processes are never interleaved
+            read_record = id_begin + new_read_name + "_0_" + str(middle_ref) + "_0" + '\n'
+            read_record += read_mutated + "\n"
 
             if fastq:
-                out_reads.write("+\n")
-                out_quals = "".join([chr(qual + 33) for qual in base_quals])
-                out_reads.write(out_quals + "\n")
-
-            if (sequence_index + 1) % 100 == 0:
-                sys.stdout.write(strftime("%Y-%m-%d %H:%M:%S") + ": Number of reads simulated >> " +
-                                 str(sequence_index + 1) + "\r")
-                # +1 is just to ignore the zero index by python
-                sys.stdout.flush()
+                read_record += "+\n" + mm.trunc_lognorm_phred("unaligned", read_type, basecaller, len(read_mutated)) + \
+                               "\n"
+            out_reads.write(read_record)
+            pf.stats.add_read(len(read_mutated))
+
             passed += 1
 
         remaining_reads = num_simulate - passed
@@ -1403,13 +1569,11 @@ def simulation_gap(ref, basecaller, read_type, dna_type, fastq):
     if ref == 0:
         return '', []
 
-    unaligned, middle_ref, error_dict, error_count = unaligned_error_list(ref, error_par)
-    new_gap, new_gap_name = extract_read(dna_type, middle_ref)
-    new_gap = case_convert(new_gap)
+    unaligned, middle_ref, error_events, error_count = unaligned_error_list(ref, error_samplers)
+    new_gap, new_gap_name, _ = extract_read(dna_type, middle_ref)
 
     # no quals returned here since unaligned quals are not based on mis/ins/match qual distributions
-    gap_mutated, _ = mutate_read(new_gap, new_gap_name, None, error_dict, error_count, basecaller, read_type, False,
-                                 False)
+    gap_mutated, _, _ = mutate_read(new_gap, new_gap_name, None, error_events, basecaller, read_type, False, False)
 
     if fastq:
         base_quals = mm.trunc_lognorm_rvs("unaligned", read_type, basecaller, len(gap_mutated)).tolist()
@@ -1419,118 +1583,262 @@ def simulation_gap(ref, basecaller, read_type, dna_type, fastq):
     return gap_mutated, base_quals
 
 
-def simulation(mode, out, dna_type, per, kmer_bias, basecaller, read_type, max_l, min_l, num_threads, fastq,
-               median_l=None, sd_l=None, model_ir=False, uracil=False, polya=None, chimeric=False):
-    global total_simulated  # Keeps track of number of reads that have been simulated so far
-    total_simulated = mp.Value("i", 0, lock=True)
+def seed_batch(run_seed, batch_key):
+    # Seed the random number generators for one batch of reads from an independent stream of the run seed, so that its
+    # reads only depend on the seed and batch_key (sample, phase and batch), and not on the process simulating it
+    seeds = np.random.SeedSequence(run_seed, spawn_key=batch_key).generate_state(2)
+    random.seed(int(seeds[0]))
+    np.random.seed(seeds[1])
+    for sampler in error_samplers.values():
+        sampler.reset()
 
-    # Start simulation
-    sys.stdout.write(strftime("%Y-%m-%d %H:%M:%S") + ": Start simulation of aligned reads\n")
-    sys.stdout.flush()
+
+def simulation_worker(worker, jobs, run_seed, task_queue, result_queue):
+    # Simulate the batches of reads from task_queue until None is received, and send their output to result_queue
+    # with the stage times and counters of the batch, as worker.
+    # Reads, true alignments and text error logs are compressed as set by their job, binary error logs never are
+    pf.stats.clear()
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        job_id, batch_id, first_index, num_simulate, plan = task
+        job = jobs[job_id]
+        seed_batch(run_seed, job.stream + (batch_id,))
+        out_reads = fh.batch_writer()
+        out_error = ep.ERROR_LOGS[job.error_format]() if job.error_format in ep.ERROR_LOGS else None
+        out_truth = fh.batch_writer() if job.truth_path else None
+        if plan is None:
+            job.simulate_batch(out_reads, out_error, out_truth, num_simulate, first_index)
+        else:
+            job.simulate_batch(out_reads, out_error, out_truth, num_simulate, first_index, plan)
+        pf.stats.start("output")
+        error_data = b""
+        if job.error_format == "text":
+            error_data = fh.compress_text(out_error.getvalue(), *job.compress)
+        elif job.error_format == "binary":
+            error_data = out_error.getvalue()
+        truth_data = fh.compress_text(out_truth.getvalue(), *job.compress) if job.truth_path else b""
+        reads_data = fh.compress_text(out_reads.getvalue(), *job.compress)
+        pf.stats.stop()
+        result_queue.put((job_id, batch_id, reads_data, error_data, truth_data, worker, pf.stats.pop()))
+
+
+class simulation_job(object):
+    # num_reads reads simulated by simulate_batch(out_reads, out_error, out_truth, num_simulate, first_index), e.g. the
+    # aligned reads of a sample, drawing from the seed streams of stream (sample and phase) and numbered from id_offset.
+    # The reads are written to reads_path, or to out_stream if given, compressed with compress (method and level).
+    # With error_path, the error logs are written to it in error_format (text or binary), and with truth_path, the true
+    # alignments are written to it. The files are opened by start when the first batch of the job is written and
+    # closed by finish, so that only the files of the job being written are open. prepare, if given, is called by the
+    # main process with the run seed and the batches of the job (batch number, first_index and num_simulate) before
+    # the batches are simulated, and returns a plan for each batch, sent with the batch and passed to simulate_batch
+    # after first_index
+    def __init__(self, messages, simulate_batch, stream, num_reads, reads_path, compress, id_offset=0,
+                 error_path=None, error_format="none", truth_path=None, out_stream=None, prepare=None):
+        self.messages = messages
+        self.simulate_batch = simulate_batch
+        self.stream = stream
+        self.num_reads = num_reads
+        self.reads_path = reads_path
+        self.compress = compress
+        self.id_offset = id_offset
+        self.error_path = error_path
+        self.error_format = error_format if error_path else "none"
+        self.truth_path = truth_path
+        self.out_stream = out_stream
+        self.prepare = prepare
+
+    def start(self):
+        for message in self.messages:
+            sys.stdout.write(strftime("%Y-%m-%d %H:%M:%S") + ": " + message + "\n")
+        sys.stdout.flush()
+        self.out_reads = self.out_stream or fh.open_output(self.reads_path, *self.compress)
+        # Binary error profiles are left uncompressed, so that they can be memory mapped
+        self.out_error = None
+        if self.error_format == "text":
+            self.out_error = fh.open_output(self.error_path, *self.compress)
+            self.out_error.write(ep.TEXT_HEADER)
+        elif self.error_format == "binary":
+            self.out_error = fh.open_output(self.error_path)
+            self.out_error.write_compressed(ep.BINARY_MAGIC)
+        self.out_truth = fh.open_output(self.truth_path, *self.compress) if self.truth_path else None
+
+    def write(self, reads_data, error_data, truth_data):
+        self.out_reads.write_compressed(reads_data)
+        if self.out_error:
+            self.out_error.write_compressed(error_data)
+        if self.out_truth:
+            self.out_truth.write_compressed(truth_data)
+
+    def finish(self):
+        # out_stream is left open for the next jobs
+        if not self.out_stream:
+            self.out_reads.close()
+        if self.out_error:
+            self.out_error.close()
+        if self.out_truth:
+            self.out_truth.close()
+        sys.stdout.write('\n')  # Start a new line because the "Number of reads simulated" is not returned
+
+
+def run_batches(jobs, run_seed, num_threads, batch_size):
+    # Split the reads of each simulation_job into batches of batch_size, simulated by a single pool of num_threads
+    # processes taking a new batch whenever they are done with one, so that the batches of the next jobs (e.g. samples)
+    # keep the processes busy while the last batches of a job finish. The output of the batches is written in order
+    # of job and batch as it arrives. At most 4 * num_threads batches are waiting to be simulated or written at any
+    # time. Returns False if a worker process died.
+    # The workers compress the output of their batches. Each batch owns the block of read indices starting at the
+    # id_offset of its job plus its first read, so workers number their reads without sharing a counter, and the
+    # progress is reported here as batches are written
+    batches = []
+    for job_id, job in enumerate(jobs):
+        batches.extend((job_id, i, job.id_offset + i * batch_size, min(batch_size, job.num_reads - i * batch_size))
+                       for i in xrange((job.num_reads + batch_size - 1) // batch_size))
+    plans = {}
+    for job_id, job in enumerate(jobs):
+        if job.prepare:
+            pf.stats.start("species_planning")
+            job_batches = [x for x in batches if x[0] == job_id]
+            plans.update(zip([x[:2] for x in job_batches], job.prepare(run_seed, [x[1:] for x in job_batches])))
+            pf.stats.stop()
+    task_queue = mp.Queue()
+    result_queue = mp.Queue()
+    procs = []
+    for i in range(num_threads):
+        p = mp.Process(target=simulation_worker, args=(i, jobs, run_seed, task_queue, result_queue))
+        procs.append(p)
+        p.start()
+
+    window = 4 * num_threads
+    next_task = 0
+    next_write = 0
+    current_job = -1
+    written = 0
+    finished = {}
+    while next_task < min(window, len(batches)):
+        task_queue.put(batches[next_task] + (plans.pop(batches[next_task][:2], None),))
+        next_task += 1
+
+    while True:
+        # Write the batches that are next in order as they arrive. Jobs are started and finished in order, including
+        # those without reads
+        while current_job < len(jobs):
+            next_job = batches[next_write][0] if next_write < len(batches) else len(jobs)
+            if current_job < next_job:
+                pf.stats.start("output")
+                if current_job >= 0:
+                    jobs[current_job].finish()
+                current_job += 1
+                if current_job < len(jobs):
+                    jobs[current_job].start()
+                    written = jobs[current_job].id_offset
+                pf.stats.stop()
+            elif batches[next_write][:2] in finished:
+                pf.stats.start("output")
+                jobs[current_job].write(*finished.pop(batches[next_write][:2]))
+                pf.stats.stop()
+                written += batches[next_write][3]
+                sys.stdout.write(strftime("%Y-%m-%d %H:%M:%S") + ": Number of reads simulated >> " + str(written) +
+                                 "\r")
+                sys.stdout.flush()
+                next_write += 1
+                if next_task < len(batches):
+                    task_queue.put(batches[next_task] + (plans.pop(batches[next_task][:2], None),))
+                    next_task += 1
+            else:
+                break
+        if current_job == len(jobs):
+            break
+
+        try:
+            job_id, batch_id, reads_data, error_data, truth_data, worker, batch_stats = result_queue.get(timeout=1)
+        except Empty:
+            if not all(p.is_alive() for p in procs):
+                for p in procs:
+                    p.terminate()
+                return False
+            continue
+        pf.report.add_worker(worker, batch_stats)
+        finished[(job_id, batch_id)] = (reads_data, error_data, truth_data)
+
+    for p in procs:
+        task_queue.put(None)
+    for p in procs:
+        p.join()
+    return True
+
+
+def simulation_jobs(mode, out, dna_type, per, kmer_bias, basecaller, read_type, max_l, min_l, fastq, median_l=None,
+                    sd_l=None, model_ir=False, uracil=False, polya=None, chimeric=False, sample_idx=0,
+                    compress="none", compress_level=6, error_format="text", truth="none", out_stream=None,
+                    messages=()):
+    # The simulation_job of the aligned reads of a sample, and of its unaligned reads unless per. messages are written
+    # when the first job starts. The numbers of reads are taken from number_aligned and number_unaligned
     if fastq:
         ext = ".fastq"
     else:
         ext = ".fasta"
 
-    procs = []
-    aligned_subfiles = []
-    error_subfiles = []
-    num_simulate = int(number_aligned / num_threads)
+    prepare = None
+    if mode == "genome":
+        def simulate_batch(out_reads, out_error, out_truth, num_simulate, first_index):
+            simulation_aligned_genome(dna_type, min_l, max_l, median_l, sd_l, out_reads, out_error, kmer_bias,
+                                      basecaller, read_type, fastq, num_simulate, per, chimeric, first_index,
+                                      out_truth)
 
-    for i in range(num_threads):
-        np.random.seed()
-        random.seed()
-        aligned_subfile = out + "_aligned_reads{}".format(i) + ext
-        error_subfile = out + "_error_profile{}".format(i)
-        aligned_subfiles.append(aligned_subfile)
-        error_subfiles.append(error_subfile)
-        if i == num_threads - 1:  # Last process will simulate the remaining reads
-            num_simulate += number_aligned % num_threads
-
-        if mode == "genome":
-            p = mp.Process(target=simulation_aligned_genome,
-                           args=(dna_type, min_l, max_l, median_l, sd_l, aligned_subfile, error_subfile,
-                                 kmer_bias, basecaller, read_type, fastq, num_simulate, per, chimeric))
-            procs.append(p)
-            p.start()
-
-        elif mode == "metagenome":
-            p = mp.Process(target=simulation_aligned_metagenome,
-                           args=(min_l, max_l, median_l, sd_l, aligned_subfile, error_subfile, kmer_bias,
-                                 basecaller, read_type, fastq, num_simulate, per, chimeric))
-            procs.append(p)
-            p.start()
+    elif mode == "metagenome":
+        # Batches of all samples share the worker processes, so each batch sets the abundances of its sample. The
+        # lengths and species of the reads are planned for the whole sample by prepare, and sent with the batches
+        sample_abun = (dict_abun, dict_abun_inflated)
 
-        else:
-            p = mp.Process(target=simulation_aligned_transcriptome,
-                           args=(model_ir, aligned_subfile, error_subfile, kmer_bias, basecaller, read_type,
-                                 num_simulate, polya, fastq, per, uracil))
-            procs.append(p)
-            p.start()
+        def prepare(run_seed, batches):
+            return plan_species(run_seed, (sample_idx, 0), batches, sample_abun, per, min_l, max_l, median_l, sd_l,
+                                chimeric)
 
-    for p in procs:
-        p.join()
+        def simulate_batch(out_reads, out_error, out_truth, num_simulate, first_index, plan):
+            global dict_abun, dict_abun_inflated
+            dict_abun, dict_abun_inflated = sample_abun
+            simulation_aligned_metagenome(min_l, max_l, median_l, sd_l, out_reads, out_error, kmer_bias, basecaller,
+                                          read_type, fastq, num_simulate, per, chimeric, first_index, out_truth, plan)
 
-    sys.stdout.write('\n')  # Start a new line because the "Number of reads simulated" is not returned
-    # Merging aligned reads subfiles and error subfiles
-    with open(out + "_aligned_reads" + ext, 'w') as out_aligned_reads:
-        for fname in aligned_subfiles:
-            with open(fname) as infile:
-                out_aligned_reads.write(infile.read())
-    for fname in aligned_subfiles:
-        os.remove(fname)
-
-    with open(out + "_aligned_error_profile", 'w') as out_error:
-        out_error.write("Seq_name\tSeq_pos\terror_type\terror_length\tref_base\tseq_base\n")
-        for fname in error_subfiles:
-            with open(fname) as infile:
-                out_error.write(infile.read())
-    for fname in error_subfiles:
-        os.remove(fname)
+    else:
+        def simulate_batch(out_reads, out_error, out_truth, num_simulate, first_index):
+            simulation_aligned_transcriptome(model_ir, out_reads, out_error, kmer_bias, basecaller, read_type,
+                                             num_simulate, polya, fastq, per, uracil, first_index, out_truth)
+
+    error_path = None
+    if error_format == "text":
+        error_path = out + "_aligned_error_profile"
+    elif error_format == "binary":
+        error_path = out + "_aligned_error_profile" + ep.BINARY_SUFFIX
+    truth_path = out + "_aligned_reads.paf" if truth == "paf" else None
+    jobs = [simulation_job(list(messages) + ["Start simulation of aligned reads"], simulate_batch, (sample_idx, 0),
+                           number_aligned, out + "_aligned_reads" + ext, (compress, compress_level),
+                           error_path=error_path, error_format=error_format, truth_path=truth_path,
+                           out_stream=out_stream, prepare=prepare)]
 
     # Simulate unaligned reads, if per, number_unaligned = 0, taken care of in read_ecdf
     if not per:
-        sys.stdout.write(strftime("%Y-%m-%d %H:%M:%S") + ": Start simulation of random reads\n")
-        sys.stdout.flush()
-        unaligned_subfiles = []
-        # unaligned_error_subfiles = []
-        num_simulate = int(number_unaligned / num_threads)
-        for i in range(num_threads):
-            unaligned_subfile = out + "_unaligned_reads{}".format(i) + ext
-            # unaligned_error_subfile = out + "_unaligned_error_profile{}".format(i) + ext
-            unaligned_subfiles.append(unaligned_subfile)
-            # unaligned_error_subfiles.append(unaligned_error_subfile)
-            if i == num_threads - 1:
-                num_simulate += number_unaligned % num_threads
-
-            # Dividing number of unaligned reads that need to be simulated amongst the number of processes
-            p = mp.Process(target=simulation_unaligned,
-                           args=(dna_type, min_l, max_l, median_l, sd_l, unaligned_subfile,
-                                 basecaller, read_type, fastq, num_simulate, uracil))
-            procs.append(p)
-            p.start()
-
-        for p in procs:
-            p.join()
+        def simulate_unaligned_batch(out_reads, out_error, out_truth, num_simulate, first_index):
+            simulation_unaligned(dna_type, min_l, max_l, median_l, sd_l, out_reads, basecaller, read_type, fastq,
+                                 num_simulate, uracil, first_index)
 
-        sys.stdout.write('\n')  # Start a new line because the "Number of reads simulated" is not returned
-        # Merging unaligned reads subfiles and error subfiles
-        with open(out + "_unaligned_reads" + ext, 'w') as out_unaligned_reads:
-            for fname in unaligned_subfiles:
-                with open(fname) as infile:
-                    out_unaligned_reads.write(infile.read())
-        for fname in unaligned_subfiles:
-            os.remove(fname)
+        jobs.append(simulation_job(["Start simulation of random reads"], simulate_unaligned_batch, (sample_idx, 1),
+                                   number_unaligned, out + "_unaligned_reads" + ext, (compress, compress_level),
+                                   id_offset=number_aligned, out_stream=out_stream))
+    return jobs
 
 
-def reverse_complement(seq):
-    comp = {'A': 'T', 'T': 'A', 'C': 'G', 'G': 'C'}
-    seq_list = list(seq)
-    reverse_seq_list = reversed([comp.get(base, base) for base in seq_list])
-    reverse_seq = ''.join(reverse_seq_list)
-    return reverse_seq
+def run_simulation(jobs, seed, num_threads, batch_size):
+    # Batches draw from streams of the seed, so the output for a seed and batch size does not depend on num_threads
+    run_seed = np.random.SeedSequence(seed).entropy
+    if not run_batches(jobs, run_seed, num_threads, batch_size):
+        sys.stderr.write("\nSimulation failed\n")
+        sys.exit(1)
 
 
+@pf.timed("extract_read")
 def extract_read_trx(key, length, trx_has_polya, buffer=10):
     # buffer: if the extracted read is within 10 base to the reference 3' end, it's considered as reaching to the end
     # TODO change the random into something truer
@@ -1542,7 +1850,10 @@ def extract_read_trx(key, length, trx_has_polya, buffer=10):
     return new_read, ref_pos, retain_polya
 
 
+@pf.timed("extract_read")
 def extract_read(dna_type, length, s=None):
+    # Also returns the blocks of the reference making up the read, as (reference name in the input file, reference
+    # length, start, block length, False), two of them if the read crosses the origin of a circular reference
     if dna_type == "transcriptome":
         while True:
             key = random.choice(list(seq_len.keys()))  # added "list" thing to be compatible with Python v3
@@ -1551,26 +1862,19 @@ def extract_read(dna_type, length, s=None):
                 new_read = seq_dict[key][ref_pos: ref_pos + length]
                 new_read_name = key + "_" + str(ref_pos)
                 break
-        return new_read, new_read_name
+            pf.stats.count("extract_retries")
+        return new_read, new_read_name, [(ref_names[key], seq_len[key], ref_pos, length, False)]
     elif dna_type == "metagenome":
-        while True:
-            if not s or length > max(seq_len[s].values()):  # if the length is too long, change to a different species
-                s = random.choice(list(seq_len.keys()))  # added "list" thing to be compatible with Python v3
-            key = random.choice(list(seq_len[s].keys()))
-            if length < seq_len[s][key]:
-                if dict_dna_type[s][key] == "circular":
-                    ref_pos = random.randint(0, seq_len[s][key])
-                    if length + ref_pos > seq_len[s][key]:
-                        new_read = seq_dict[s][key][ref_pos:]
-                        new_read = new_read + seq_dict[s][key][0: length - seq_len[s][key] + ref_pos]
-                    else:
-                        new_read = seq_dict[s][key][ref_pos: ref_pos + length]
-                else:
-                    ref_pos = random.randint(0, seq_len[s][key] - length)
-                    new_read = seq_dict[s][key][ref_pos: ref_pos + length]
-                new_read_name = s + '-' + key + "_" + str(ref_pos)
-                break
-        return new_read, new_read_name
+        # Draw a start position uniformly among all positions of species s where the read fits, so contigs are chosen
+        # in proportion to their usable length. If the read is too long for s, change to a different species
+        s, key, ref_pos = metagenome_sampler.sample(length, s or None)
+        if length + ref_pos > seq_len[s][key]:  # circular contig, the read crosses its origin
+            new_read = seq_dict[s][key][ref_pos:]
+            new_read = new_read + seq_dict[s][key][0: length - seq_len[s][key] + ref_pos]
+        else:
+            new_read = seq_dict[s][key][ref_pos: ref_pos + length]
+        new_read_name = s + '-' + key + "_" + str(ref_pos)
+        return new_read, new_read_name, circular_blocks(ref_names[s][key], seq_len[s][key], ref_pos, length)
     else:
         # Extract the aligned region from reference
         if dna_type == "circular":
@@ -1582,39 +1886,40 @@ def extract_read(dna_type, length, s=None):
             else:
                 new_read = seq_dict[chromosome][ref_pos:]
                 new_read = new_read + seq_dict[chromosome][0: length - genome_len + ref_pos]
+            blocks = circular_blocks(ref_names[chromosome], genome_len, ref_pos, length)
         else:
-            # Generate a random number within the size of the genome. Suppose chromosomes are connected
-            # tail to head one by one in the order of the dictionary. If the start position fits in one
-            # chromosome, but the end position does not, then restart generating random number.
+            # Draw a start position uniformly among all positions where the read fits in one chromosome, so
+            # chromosomes are chosen in proportion to their usable length.
             # This is designed for genomes with multiple chromosomes which varies a lot in lengths
+            key, ref_pos = genome_sampler.sample(length)
+            new_read = seq_dict[key][ref_pos: ref_pos + length]
+            new_read_name = key + "_" + str(ref_pos)
+            blocks = [(ref_names[key], seq_len[key], ref_pos, length, False)]
+        return new_read, new_read_name, blocks
 
-            while True:
-                new_read = ""
-                ref_pos = random.randint(0, genome_len)
-                for key in seq_len:
-                    if ref_pos + length <= seq_len[key]:
-                        new_read = seq_dict[key][ref_pos: ref_pos + length]
-                        new_read_name = key + "_" + str(ref_pos)
-                        break
-                    elif ref_pos < seq_len[key]:
-                        break
-                    else:
-                        ref_pos -= seq_len[key]
-                if new_read != "":
-                    break
-        return new_read, new_read_name
 
+def circular_blocks(name, ref_len, ref_pos, length):
+    # Blocks of a read of length starting at ref_pos of a circular reference, split at the origin
+    if ref_pos + length <= ref_len:
+        return [(name, ref_len, ref_pos, length, False)]
+    return [(name, ref_len, ref_pos, ref_len - ref_pos, False), (name, ref_len, 0, ref_pos + length - ref_len, False)]
 
-def unaligned_error_list(m_ref, error_p):
+
+@pf.timed("error_list")
+def unaligned_error_list(m_ref, error_samplers):
+    # Errors are returned as arrays of positions, types (index in ep.ERROR_TYPES) and lengths like in error_list_batch,
+    # an insertion after base pos is placed before base pos + 1
     l_new = m_ref
-    e_dict = {}
+    e_pos = []
+    e_type = []
+    e_len = []
     error_rate = {(0, 0.4): "match", (0.4, 0.7): "mis", (0.7, 0.85): "ins", (0.85, 1): "del"}
     pos = 0
     middle_ref = m_ref
     last_is_ins = False
     e_count = {"match": 0, "mis": 0, "ins": 0}  # Not used; added to be consistent with error_list()
     if m_ref == 0:
-        return l_new, middle_ref, e_dict, e_count
+        return l_new, middle_ref, (np.array(e_pos), np.array(e_type), np.array(e_len)), e_count
     while pos < middle_ref:
         p = random.random()
         for k_error in error_rate.keys():
@@ -1626,21 +1931,27 @@ def unaligned_error_list(m_ref, error_p):
             step = 1
 
         elif error_type == "mis":
-            step = mm.pois_geom(error_p["mis"][0], error_p["mis"][2], error_p["mis"][3])
-            e_dict[pos] = ["mis", step]
+            step = error_samplers["mis"].draw()
+            e_pos.append(pos)
+            e_type.append(0)
+            e_len.append(step)
 
         elif error_type == "ins":
-            step = mm.wei_geom(error_p["ins"][0], error_p["ins"][1], error_p["ins"][2], error_p["ins"][3])
+            step = error_samplers["ins"].draw()
             if last_is_ins:
-                e_dict[pos + 0.1][1] += step
+                e_len[-1] += step
             else:
-                e_dict[pos + 0.1] = ["ins", step]
+                e_pos.append(pos + 1)
+                e_type.append(1)
+                e_len.append(step)
                 last_is_ins = True
             l_new += step
 
         else:
-            step = mm.wei_geom(error_p["del"][0], error_p["del"][1], error_p["del"][2], error_p["del"][3])
-            e_dict[pos] = ["del", step]
+            step = error_samplers["del"].draw()
+            e_pos.append(pos)
+            e_type.append(2)
+            e_len.append(step)
             l_new -= step
 
         if error_type != "ins":
@@ -1651,192 +1962,192 @@ def unaligned_error_list(m_ref, error_p):
             l_new += pos - middle_ref
             middle_ref = pos
 
-    return l_new, middle_ref, e_dict, e_count
+    return l_new, middle_ref, (np.array(e_pos, dtype=np.int64), np.array(e_type, dtype=np.int64),
+                               np.array(e_len, dtype=np.int64)), e_count
 
 
-def error_list(m_ref, m_model, m_ht_list, error_p, trans_p, fastq):
-    # l_old is the original length, and l_new is used to control the new length after introducing errors
-    l_new = m_ref
-    pos = 0
-    e_dict = {}
-    middle_ref = m_ref
-    prev_error = "start"
-    e_count = {"mis": 0, "ins": 0, "match": 0}
+@pf.timed("error_list")
+def error_list_batch(m_ref_list, m_model, m_ht_list, error_p, trans_p, fastq):
+    # Run the error / match Markov chain of error_list for all reads in lock step, one event per read per iteration.
+    # Returns l_new, middle_ref and e_count (columns mis, ins, match) as arrays, and the error events of all reads
+    # in CSR form: events of read i are e_pos, e_type, e_len[e_offsets[i]: e_offsets[i + 1]], sorted by position.
+    # e_type indexes ep.ERROR_TYPES, insertions are placed before the base at e_pos.
+    m_ref = np.asarray(m_ref_list, dtype=np.int64)
+    num_reads = len(m_ref)
+    l_new = m_ref.copy()
+    middle_ref = m_ref.copy()
+    e_count = np.zeros((num_reads, 3), dtype=np.int64)
 
     # The first match come from m_ht_list
-    p = random.random()
-    k1 = list(m_ht_list.keys())[0]
-    for k2, v2 in m_ht_list[k1].items():
-        if k2[0] < p <= k2[1]:
-            prev_match = int(np.floor((p - k2[0]) / (k2[1] - k2[0]) * (v2[1] - v2[0]) + v2[0]))
-            if prev_match < 2:
-                prev_match = 2
-    pos += prev_match
+    prev_match = np.maximum(ecdf_lookup(m_ht_list, np.zeros(num_reads), np.random.random(num_reads)), 2)
+    pos = prev_match.copy()
     if fastq:
-        if prev_match > middle_ref: 
-            e_count["match"] += middle_ref
-        else:
-            e_count["match"] += prev_match
+        e_count[:, 2] = np.minimum(prev_match, middle_ref)
+
+    state = np.zeros(num_reads, dtype=np.int64)
+    ev_read = []
+    ev_pos = []
+    ev_type = []
+    ev_len = []
 
     # Select an error, then the step size, and then a match and so on so forth.
-    while pos < middle_ref:
+    active = np.flatnonzero(pos < middle_ref)
+    while len(active) > 0:
         # pick the error based on Markov chain
-        p = random.random()
-        for k in trans_p[prev_error].keys():
-            if k[0] <= p < k[1]:
-                error = trans_p[prev_error][k]
-                break
-
-        if error == "mis":
-            step = mm.pois_geom(error_p[error][0], error_p[error][2], error_p[error][3])
-        elif error == "ins":
-            step = mm.wei_geom(error_p[error][0], error_p[error][1], error_p[error][2], error_p[error][3])
-            l_new += step
-        else:
-            step = mm.wei_geom(error_p[error][0], error_p[error][1], error_p[error][2], error_p[error][3])
-            l_new -= step
-
-        if error != "ins":
-            e_dict[pos] = [error, step]
-            pos += step
-            if pos >= middle_ref:
-                l_new += pos - middle_ref
-                middle_ref = pos
-        else:
-            e_dict[pos - 0.5] = [error, step]
-
-        prev_error = error
+        p = np.random.random(len(active))
+        thresholds = trans_p[state[active]]
+        error = (p >= thresholds[:, 0]).astype(np.int64) + (p >= thresholds[:, 1])
+
+        step = np.empty(len(active), dtype=np.int64)
+        is_mis = error == 0
+        is_ins = error == 1
+        is_del = error == 2
+        if is_mis.any():
+            par = error_p["mis"]
+            step[is_mis] = mm.pois_geom_rvs(par[0], par[2], par[3], np.count_nonzero(is_mis))
+        if is_ins.any():
+            par = error_p["ins"]
+            step[is_ins] = mm.wei_geom_rvs(par[0], par[1], par[2], par[3], np.count_nonzero(is_ins))
+        if is_del.any():
+            par = error_p["del"]
+            step[is_del] = mm.wei_geom_rvs(par[0], par[1], par[2], par[3], np.count_nonzero(is_del))
+
+        cur = pos[active]
+        ev_read.append(active)
+        ev_pos.append(cur)
+        ev_type.append(error)
+        ev_len.append(step)
+
+        l_new[active] += np.where(is_ins, step, 0) - np.where(is_del, step, 0)
+        cur = cur + np.where(is_ins, 0, step)
+        over = np.maximum(cur - middle_ref[active], 0)
+        l_new[active] += over
+        middle_ref[active] += over
 
         if fastq:
-            if error == "mis" or error == "ins":
-                e_count[error] += step
+            e_count[active, 0] += np.where(is_mis, step, 0)
+            e_count[active, 1] += np.where(is_ins, step, 0)
 
         # Randomly select a match length
-        for k1 in m_model.keys():
-            if k1[0] <= prev_match < k1[1]:
-                break
-        p = random.random()
-        for k2, v2 in m_model[k1].items():
-            if k2[0] < p <= k2[1]:
-                step = int(np.floor((p - k2[0]) / (k2[1] - k2[0]) * (v2[1] - v2[0]) + v2[0]))
-                break
+        match = ecdf_lookup(m_model, prev_match[active], np.random.random(len(active)))
         # there are no two 0 base matches together
-        if prev_match == 0 and step == 0:
-            step = 1
-
-        prev_match = step
+        match[(prev_match[active] == 0) & (match == 0)] = 1
+        prev_match[active] = match
 
         if fastq:
-            e_count["match"] += step
-
-        if pos + prev_match > middle_ref:
-            l_new += pos + prev_match - middle_ref
-            middle_ref = pos + prev_match
-
-        pos += prev_match
-        if prev_match == 0:
-            prev_error += "0"
-
-    return l_new, middle_ref, e_dict, e_count
-
-
-def mutate_read(read, read_name, error_log, e_dict, e_count, basecaller, read_type, fastq, k):
-    if k:  # First remove any errors that land in hp regions
-        pattern = "A{" + re.escape(str(k)) + ",}|C{" + re.escape(str(k)) + ",}|G{" + re.escape(str(k)) + ",}|T{" + \
-                  re.escape(str(k)) + ",}"
-
-        hp_pos = []  # [[start, end], ...]
-        for match in re.finditer(pattern, read):
-            hp_pos.append([match.start(), match.end()])
-
-        new_e_dict = {}
-        for err_start in e_dict.keys():
-            err = e_dict[err_start][0]
-            err_end = err_start + e_dict[err_start][1]
-            hp_err = False
-
-            for hp in hp_pos:
-                hp_start = hp[0]
-                hp_end = hp[1]
-                if not (hp_end <= err_start or err_end <= hp_start):  # Lands in hp; remove err
-                    hp_err = True
-                    if fastq:  # Convert err qual to match qual
-                        if err != "ins":
-                            e_count["match"] += e_dict[err_start][1]
-                        if err != "del":
-                            e_count[err] -= e_dict[err_start][1]
-                    break
-
-            if not hp_err:
-                new_e_dict[err_start] = [err, e_dict[err_start][1]]
-
+            e_count[active, 2] += match
+
+        over = np.maximum(cur + match - middle_ref[active], 0)
+        l_new[active] += over
+        middle_ref[active] += over
+        pos[active] = cur + match
+
+        state[active] = error + 1 + 3 * (match == 0)
+        active = active[pos[active] < middle_ref[active]]
+
+    if ev_read:
+        ev_read = np.concatenate(ev_read)
+        order = np.argsort(ev_read, kind="stable")
+        ev_read = ev_read[order]
+        e_pos = np.concatenate(ev_pos)[order]
+        e_type = np.concatenate(ev_type)[order]
+        e_len = np.concatenate(ev_len)[order]
+
+        # Two insertions separated by a 0 base match are one insertion
+        same_ins = (e_type[1:] == 1) & (e_type[:-1] == 1) & (ev_read[1:] == ev_read[:-1]) & (e_pos[1:] == e_pos[:-1])
+        if same_ins.any():
+            first = np.flatnonzero(np.concatenate(([True], ~same_ins)))
+            e_len = np.add.reduceat(e_len, first)
+            ev_read = ev_read[first]
+            e_pos = e_pos[first]
+            e_type = e_type[first]
     else:
-        new_e_dict = e_dict
+        ev_read = e_pos = e_type = e_len = np.zeros(0, dtype=np.int64)
 
-    if fastq:  # Sample base qualities for mis/ins/match
-        mis_quals = mm.trunc_lognorm_rvs("mis", read_type, basecaller, e_count["mis"]).tolist()
-        ins_quals = mm.trunc_lognorm_rvs("ins", read_type, basecaller, e_count["ins"]).tolist()
-        match_quals = mm.trunc_lognorm_rvs("match", read_type, basecaller, e_count["match"]).tolist()
+    e_offsets = np.searchsorted(ev_read, np.arange(num_reads + 1))
+    return l_new, middle_ref, e_count, e_offsets, e_pos, e_type, e_len
 
-    # Mutate read
-    quals = []
-    prev = len(read)
-    for key in sorted(new_e_dict.keys(), reverse=True):
-        val = new_e_dict[key]
-        key = math.ceil(key)  # Ceil instead of round for consistent match calculations during base qual sim
-        err_quals = []
-
-        if val[0] == "mis":
-            ref_base = read[key: key + val[1]]
-            new_bases = ""
-            for i in xrange(val[1]):
-                tmp_bases = list(BASES)
-                tmp_bases.remove(read[key + i])
-                # tmp_bases.remove(read[key]) ## Edited this part for testing
-                new_base = random.choice(tmp_bases)
-                new_bases += new_base
-                if fastq:
-                    err_quals.append(mis_quals.pop())
-
-            new_read = read[:key] + new_bases + read[key + val[1]:]
-            err_end = key + val[1]
-
-        elif val[0] == "del":
-            new_bases = val[1] * "-"
-            ref_base = read[key: key + val[1]]
-            new_read = read[: key] + read[key + val[1]:]
-            err_end = key + val[1]
-
-        elif val[0] == "ins":
-            ref_base = val[1] * "-"
-            new_bases = ""
-            for i in xrange(val[1]):
-                new_base = random.choice(BASES)
-                new_bases += new_base
-                if fastq:
-                    err_quals.append(ins_quals.pop())
-            new_read = read[:key] + new_bases + read[key:]
-            err_end = key
 
-        if fastq:
-            if err_end != prev:  # Match after error
-                for j in xrange(prev - err_end):
-                    quals.append(match_quals.pop())
-            quals += err_quals
+def error_batch_item(error_batch, i):
+    # Results of error_list_batch for read i, in the form returned by error_list
+    l_new, middle_ref, e_count, e_offsets, e_pos, e_type, e_len = error_batch
+    start = e_offsets[i]
+    end = e_offsets[i + 1]
+    count = {"mis": int(e_count[i][0]), "ins": int(e_count[i][1]), "match": int(e_count[i][2])}
+    return int(l_new[i]), int(middle_ref[i]), (e_pos[start:end], e_type[start:end], e_len[start:end]), count
 
-        read = new_read
-        prev = key
 
-        if val[0] != "match" and error_log:
-            error_log.write(read_name + "\t" + str(key) + "\t" + val[0] + "\t" + str(val[1]) +
-                            "\t" + ref_base + "\t" + new_bases + "\n")
+def error_list(m_ref, m_model, m_ht_list, error_p, trans_p, fastq):
+    # l_old is the original length, and l_new is used to control the new length after introducing errors
+    return error_batch_item(error_list_batch([m_ref], m_model, m_ht_list, error_p, trans_p, fastq), 0)
+
+
+def expand_intervals(starts, lengths):
+    # Positions covered by intervals [starts[i], starts[i] + lengths[i]), in order
+    ends = np.cumsum(lengths)
+    return np.repeat(starts - ends + lengths, lengths) + np.arange(ends[-1] if len(ends) else 0)
+
+
+@pf.timed("mutate_read")
+def mutate_read(read, read_name, error_log, e_events, basecaller, read_type, fastq, k):
+    # e_events are the position, type and length arrays of errors from error_list or unaligned_error_list. Errors
+    # are applied in one pass: mismatches and deletions in place on the bases of the read, then all insertions at once.
+    # Also returns the offset in read of each base of the mutated read, -1 for inserted bases
+    # With k, the mutated read is returned as an rf.fragment with the homopolymers of read (of the reference index for
+    # fragments of a reference), which are left without errors for mutate_homo
+    e_pos, e_type, e_len = e_events
+    if k:
+        hp_start, hp_end = rf.homopolymers(read, k)
+    if k and len(e_pos) > 0 and len(hp_start) > 0:  # First remove any errors that land in hp regions
+        # Errors and homopolymers are both sorted, so the first hp ending after the start of an error is the only one
+        # it can land in
+        err_start = np.where(e_type == 1, e_pos - 0.5, e_pos)
+        err_end = err_start + e_len
+        hp_idx = np.searchsorted(hp_end, err_start, side="right")
+        hp_err = np.zeros(len(e_pos), dtype=bool)
+        in_range = hp_idx < len(hp_start)
+        hp_err[in_range] = hp_start[hp_idx[in_range]] < err_end[in_range]
+        e_pos = e_pos[~hp_err]
+        e_type = e_type[~hp_err]
+        e_len = e_len[~hp_err]
+
+    is_mis = e_type == 0
+    is_ins = e_type == 1
+    is_del = e_type == 2
+    mis_pos = expand_intervals(e_pos[is_mis], e_len[is_mis])
+    ins_pos = np.repeat(e_pos[is_ins], e_len[is_ins])
+
+    read_bases = np.frombuffer(read.encode(), dtype=np.uint8)
+    new_bases = read_bases.copy()
+    new_bases[mis_pos] = MIS_SUBS[read_bases[mis_pos], np.random.randint(0, 3, len(mis_pos))]
+    ins_bases = BASE_CODES[np.random.randint(0, 4, len(ins_pos))]
+    keep = np.ones(len(read_bases), dtype=bool)
+    keep[expand_intervals(e_pos[is_del], e_len[is_del])] = False
+    keep = np.insert(keep, ins_pos, True)
+    new_read = np.insert(new_bases, ins_pos, ins_bases)[keep].tobytes().decode()
+    ref_map = np.insert(np.arange(len(read_bases)), ins_pos, -1)[keep]
+    if k:
+        # Homopolymers are kept whole, so their starts are moved by the errors before them
+        mapped = np.flatnonzero(ref_map >= 0)
+        new_start = mapped[np.searchsorted(ref_map[mapped], hp_start)]
+        new_read = rf.fragment(new_read, (new_start, new_start + hp_end - hp_start))
+
+    quals = []
+    if fastq:  # Sample base qualities for mis/ins/match
+        qual_type = np.zeros(len(read_bases), dtype=np.uint8)
+        qual_type[mis_pos] = 1
+        qual_type = np.insert(qual_type, ins_pos, 2)[keep]
+        quals = np.empty(len(qual_type), dtype=np.int64)
+        for i, error_type in enumerate(("match", "mis", "ins")):
+            is_type = qual_type == i
+            quals[is_type] = mm.trunc_lognorm_rvs(error_type, read_type, basecaller, np.count_nonzero(is_type))
+        quals = quals.tolist()
 
-    if fastq:  # Add first match quals
-        while len(match_quals) > 0:
-            quals.append(match_quals.pop())
+    if error_log is not None and len(e_pos) > 0:
+        ref, new = ep.event_bases(read_bases, new_bases, ins_bases, e_pos, e_type, e_len)
+        error_log.write_events(read_name, e_pos, e_type, e_len, ref, new)
 
-    quals.reverse()
-    return read, quals
+    return new_read, quals, ref_map
 
 
 def inflate_abun(original_dict, inflated_species):
@@ -1904,6 +2215,23 @@ def main():
     parser_g.add_argument('--chimeric', help='Simulate chimeric reads', action='store_true', default=False)
     parser_g.add_argument('-t', '--num_threads', help='Number of threads for simulation (Default = 1)', type=int,
                           default=1)
+    parser_g.add_argument('--batch_size', help='Number of reads simulated at a time by a thread. With --seed, '
+                          'the output only depends on the seed and batch size, not on the number of threads '
+                          '(Default = ' + str(BATCH_SIZE) + ')', type=int, default=BATCH_SIZE)
+    parser_g.add_argument('--compress', help='Compress the simulated reads and error profiles with gzip, or with bgzf '
+                          '(blocked gzip, readable by gzip and indexable by samtools/tabix) (Default = none)',
+                          choices=["none", "gzip", "bgzf"], default="none")
+    parser_g.add_argument('--compress_level', help='Compression level, from 1 (fastest) to 9 (smallest) (Default = 6)',
+                          type=int, choices=range(1, 10), default=6, metavar="[1-9]")
+    parser_g.add_argument('--error_profile', help='Format of the error profile of aligned reads: text, binary '
+                          '(memory mappable, converted to text by error_profile.py), or none to skip it '
+                          '(Default = text)', choices=["text", "binary", "none"], default="text")
+    parser_g.add_argument('--truth', help='Also write the true alignment of each aligned read to its reference, in '
+                          'PAF format with CIGAR (cg tag) and edit distance (NM tag) (Default = none)',
+                          choices=["none", "paf"], default="none")
+    parser_g.add_argument('--stream', help='Write all simulated reads, aligned then unaligned, to a single stream '
+                          'instead of the read files: - for the standard output (status messages then go to '
+                          'the standard error), or a path such as a named pipe', default=None)
 
     parser_t = subparsers.add_parser('transcriptome', help="Run the simulator on transcriptome mode")
     parser_t.add_argument('-rt', '--ref_t', help='Input reference transcriptome', required=True)
@@ -1944,6 +2272,23 @@ def main():
                           default=False)
     parser_t.add_argument('-t', '--num_threads', help='Number of threads for simulation (Default = 1)', type=int,
                           default=1)
+    parser_t.add_argument('--batch_size', help='Number of reads simulated at a time by a thread. With --seed, '
+                          'the output only depends on the seed and batch size, not on the number of threads '
+                          '(Default = ' + str(BATCH_SIZE) + ')', type=int, default=BATCH_SIZE)
+    parser_t.add_argument('--compress', help='Compress the simulated reads and error profiles with gzip, or with bgzf '
+                          '(blocked gzip, readable by gzip and indexable by samtools/tabix) (Default = none)',
+                          choices=["none", "gzip", "bgzf"], default="none")
+    parser_t.add_argument('--compress_level', help='Compression level, from 1 (fastest) to 9 (smallest) (Default = 6)',
+                          type=int, choices=range(1, 10), default=6, metavar="[1-9]")
+    parser_t.add_argument('--error_profile', help='Format of the error profile of aligned reads: text, binary '
+                          '(memory mappable, converted to text by error_profile.py), or none to skip it '
+                          '(Default = text)', choices=["text", "binary", "none"], default="text")
+    parser_t.add_argument('--truth', help='Also write the true alignment of each aligned read to its reference, in '
+                          'PAF format with CIGAR (cg tag) and edit distance (NM tag) (Default = none)',
+                          choices=["none", "paf"], default="none")
+    parser_t.add_argument('--stream', help='Write all simulated reads, aligned then unaligned, to a single stream '
+                          'instead of the read files: - for the standard output (status messages then go to '
+                          'the standard error), or a path such as a named pipe', default=None)
     parser_t.add_argument('--uracil', help='Converts the thymine (T) bases to uracil (U) in the output fasta format',
                           action='store_true', default=False)
 
@@ -1996,6 +2341,23 @@ def main():
     parser_mg.add_argument('--chimeric', help='Simulate chimeric reads', action='store_true', default=False)
     parser_mg.add_argument('-t', '--num_threads', help='Number of threads for simulation (Default = 1)', type=int,
                            default=1)
+    parser_mg.add_argument('--batch_size', help='Number of reads simulated at a time by a thread. With --seed, '
+                           'the output only depends on the seed and batch size, not on the number of threads '
+                           '(Default = ' + str(BATCH_SIZE) + ')', type=int, default=BATCH_SIZE)
+    parser_mg.add_argument('--compress', help='Compress the simulated reads and error profiles with gzip, or with bgzf '
+                           '(blocked gzip, readable by gzip and indexable by samtools/tabix) (Default = none)',
+                           choices=["none", "gzip", "bgzf"], default="none")
+    parser_mg.add_argument('--compress_level', help='Compression level, from 1 (fastest) to 9 (smallest) (Default = 6)',
+                           type=int, choices=range(1, 10), default=6, metavar="[1-9]")
+    parser_mg.add_argument('--error_profile', help='Format of the error profile of aligned reads: text, binary '
+                           '(memory mappable, converted to text by error_profile.py), or none to skip it '
+                           '(Default = text)', choices=["text", "binary", "none"], default="text")
+    parser_mg.add_argument('--truth', help='Also write the true alignment of each aligned read to its reference, in '
+                           'PAF format with CIGAR (cg tag) and edit distance (NM tag) (Default = none)',
+                           choices=["none", "paf"], default="none")
+    parser_mg.add_argument('--stream', help='Write all simulated reads, aligned then unaligned, to a single stream '
+                           'instead of the read files: - for the standard output (status messages then go to '
+                           'the standard error), or a path such as a named pipe', default=None)
     
     args = parser.parse_args()
 
@@ -2003,6 +2365,17 @@ def main():
         parser.print_help(sys.stderr)
         sys.exit(1)
 
+    # Streamed reads take over the standard output, so status messages are redirected to the standard error until the
+    # end of the run
+    stdout = sys.stdout
+    out_stream = None
+    if args.stream == "-":
+        out_stream = fh.compressed_writer(os.fdopen(os.dup(sys.stdout.fileno()), 'wb'), args.compress,
+                                          args.compress_level)
+        sys.stdout = sys.stderr
+    elif args.stream:
+        out_stream = fh.compressed_writer(open(args.stream, 'wb'), args.compress, args.compress_level)
+
     if args.mode == "genome":
         ref_g = args.ref_g
         model_prefix = args.model_prefix
@@ -2022,6 +2395,7 @@ def main():
         strandness = args.strandness
         dna_type = args.dna_type
         num_threads = max(args.num_threads, 1)
+        batch_size = max(args.batch_size, 1)
         fastq = args.fastq
 
         if kmer_bias and kmer_bias < 0:
@@ -2104,8 +2478,11 @@ def main():
         number_aligned = number_aligned_l[0]
         number_unaligned = number_unaligned_l[0]
         max_len = min(max_len, max_chrom)
-        simulation(args.mode, out, dna_type, perfect, kmer_bias, basecaller, "DNA", max_len, min_len, num_threads,
-                   fastq, median_len, sd_len, chimeric=chimeric)
+        jobs = simulation_jobs(args.mode, out, dna_type, perfect, kmer_bias, basecaller, "DNA", max_len, min_len,
+                               fastq, median_len, sd_len, chimeric=chimeric, compress=args.compress,
+                               compress_level=args.compress_level, error_format=args.error_profile,
+                               truth=args.truth, out_stream=out_stream)
+        run_simulation(jobs, args.seed, num_threads, batch_size)
 
     elif args.mode == "transcriptome":
         ref_g = args.ref_g
@@ -2129,6 +2506,7 @@ def main():
         polya = args.polya
         uracil = args.uracil
         num_threads = max(args.num_threads, 1)
+        batch_size = max(args.batch_size, 1)
         fastq = args.fastq
 
         if kmer_bias and kmer_bias < 0:
@@ -2201,8 +2579,11 @@ def main():
         number_aligned = number_aligned_l[0]
         number_unaligned = number_unaligned_l[0]
         max_len = min(max_len, max_chrom)
-        simulation(args.mode, out, dna_type, perfect, kmer_bias, basecaller, read_type, max_len, min_len, num_threads,
-                   fastq, None, None, model_ir, uracil, polya)
+        jobs = simulation_jobs(args.mode, out, dna_type, perfect, kmer_bias, basecaller, read_type, max_len, min_len,
+                               fastq, None, None, model_ir, uracil, polya, compress=args.compress,
+                               compress_level=args.compress_level, error_format=args.error_profile,
+                               truth=args.truth, out_stream=out_stream)
+        run_simulation(jobs, args.seed, num_threads, batch_size)
 
     elif args.mode == "metagenome":
         genome_list = args.genome_list
@@ -2225,6 +2606,7 @@ def main():
         fastq = args.fastq
         chimeric = args.chimeric
         num_threads = max(args.num_threads, 1)
+        batch_size = max(args.batch_size, 1)
 
         if kmer_bias and kmer_bias < 0:
             print("\nPlease input proper kmer bias value >= 0\n")
@@ -2296,8 +2678,9 @@ def main():
         read_profile(genome_list, [], model_prefix, perfect, args.mode, strandness, dna_type=dna_type_list, abun=abun,
                      chimeric=chimeric)
 
-        # Add abundance variation
+        # The samples are simulated as one run by the same worker processes, each sample bringing its abundances
         global dict_abun, dict_abun_inflated
+        jobs = []
         for s in range(len(multi_dict_abun)):
             sample = list(multi_dict_abun.keys())[s]
             if abun_var:
@@ -2311,25 +2694,31 @@ def main():
                 dict_abun = multi_dict_abun[sample]
 
             # when simulating chimeric reads, the source species for succedent segments have an inflated abundance dist
+            dict_abun_inflated = {}
             if chimeric:
-                dict_abun_inflated = {}
                 for species in dict_abun:
                     dict_abun_inflated[species] = inflate_abun(dict_abun, species)
 
-            sys.stdout.write(strftime("%Y-%m-%d %H:%M:%S") + ": Simulating sample " + sample + '\n')
-            sys.stdout.flush()
+            messages = ["Simulating sample " + sample]
             if median_len and sd_len:
-                sys.stdout.write(
-                    strftime("%Y-%m-%d %H:%M:%S") + ": Simulating read length from log-normal distribution\n")
-                sys.stdout.flush()
+                messages.append("Simulating read length from log-normal distribution")
 
             number_aligned = number_aligned_l[s]
             number_unaligned = number_unaligned_l[s]
             max_len = min(max_len, max(max_chrom.values()))
-            simulation(args.mode, out + "_" + sample, "metagenome", perfect, kmer_bias, basecaller, "DNA", max_len,
-                       min_len, num_threads, fastq, median_len, sd_len, chimeric=chimeric)
-
+            jobs.extend(simulation_jobs(args.mode, out + "_" + sample, "metagenome", perfect, kmer_bias, basecaller,
+                                        "DNA", max_len, min_len, fastq, median_len, sd_len, chimeric=chimeric,
+                                        sample_idx=s, compress=args.compress, compress_level=args.compress_level,
+                                        error_format=args.error_profile, truth=args.truth, out_stream=out_stream,
+                                        messages=messages))
+        run_simulation(jobs, args.seed, num_threads, batch_size)
+
+    if out_stream:
+        out_stream.close()
+    pf.report.write(args.output + "_performance.json", {"arguments": vars(args)})
     sys.stdout.write(strftime("%Y-%m-%d %H:%M:%S") + ": Finished!\n")
+    sys.stdout.flush()
+    sys.stdout = stdout
     sys.stdout.close()
 
 
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+"""
+This script builds the true alignments of the reads simulated by simulator.py to their references, in PAF format with
+the CIGAR (cg tag) and edit distance (NM tag) of each alignment
+"""
+
+import numpy as np
+
+
+CIGAR_OPS = "MID"
+
+
+def cigar_runs(ref_map):
+    # CIGAR operations (index in CIGAR_OPS) and lengths of the read bases mapped by ref_map, from the first to the last
+    # mapped base. ref_map holds the reference offset of each read base, increasing, and -1 for inserted bases.
+    # Deletions are put before the insertions found between the same two mapped bases
+    read_idx = np.flatnonzero(ref_map >= 0)
+    num_mapped = len(read_idx)
+    lengths = np.ones((num_mapped, 3), dtype=np.int64)
+    lengths[:-1, 1] = np.diff(ref_map[read_idx]) - 1
+    lengths[:-1, 2] = np.diff(read_idx) - 1
+    lengths[-1, 1:] = 0
+    ops = np.tile([0, 2, 1], num_mapped)
+    lengths = lengths.ravel()
+    ops = ops[lengths > 0]
+    lengths = lengths[lengths > 0]
+    run_start = np.flatnonzero(np.concatenate(([True], ops[1:] != ops[:-1])))
+    return ops[run_start], np.add.reduceat(lengths, run_start)
+
+
+def paf_records(read_name, read_len, head, reverse, segments):
+    # PAF lines of a read of read_len bases, made of head random bases and the aligned segments (reverse complemented
+    # if reverse). Each segment is (offset in the read after the head, read bases, ref_map, reference bases, blocks):
+    # ref_map gives the offset in the reference bases of each read base (-1 for inserted bases), and blocks the
+    # pieces of the reference bases as (target name, target length, target start, length, reverse complemented).
+    # Each block gets its own record, and the one with the most matches is the primary alignment
+    records = []
+    for seg_offset, read_seq, ref_map, ref_seq, blocks in segments:
+        read_bases = np.frombuffer(read_seq.encode(), dtype=np.uint8)
+        ref_bases = np.frombuffer(ref_seq.encode(), dtype=np.uint8)
+        block_start = 0
+        for target, target_len, target_start, length, block_reverse in blocks:
+            in_block = np.flatnonzero((ref_map >= block_start) & (ref_map < block_start + length))
+            if len(in_block) == 0:
+                block_start += length
+                continue
+            q_start = in_block[0]
+            q_end = in_block[-1] + 1
+            block_map = ref_map[q_start: q_end]
+            mapped = block_map >= 0
+            mismatches = np.count_nonzero(read_bases[q_start: q_end][mapped] != ref_bases[block_map[mapped]])
+            block_map = np.where(mapped, block_map - block_start, -1)
+            if block_reverse:
+                block_map = np.where(mapped, length - 1 - block_map, -1)[::-1]
+            ops, lengths = cigar_runs(block_map)
+            first = block_map[block_map >= 0][0]
+            last = block_map[block_map >= 0][-1]
+
+            num_ins = lengths[ops == 1].sum()
+            num_del = lengths[ops == 2].sum()
+            num_mapped = np.count_nonzero(mapped)
+            q_start += head + seg_offset
+            q_end += head + seg_offset
+            if reverse:
+                q_start, q_end = read_len - q_end, read_len - q_start
+            records.append([num_mapped - mismatches, read_name, read_len, q_start, q_end,
+                            "-" if reverse != block_reverse else "+", target, target_len, target_start + first,
+                            target_start + last + 1, num_mapped - mismatches, num_mapped + num_ins + num_del, 60,
+                            mismatches + num_ins + num_del,
+                            ''.join(str(x) + CIGAR_OPS[y] for x, y in zip(lengths.tolist(), ops.tolist()))])
+            block_start += length
+
+    if not records:
+        return ""
+    primary = max(range(len(records)), key=lambda x: records[x][0])
+    lines = []
+    for i, record in enumerate(records):
+        lines.append('\t'.join(str(x) for x in record[1: 13]) + "\ttp:A:" + ("P" if i == primary else "S") +
+                     "\tNM:i:" + str(record[13]) + "\tcg:Z:" + record[14] + "\n")
+    return ''.join(lines)